@@ -1,19 +1,8 @@
-import json
-from PIL import Image
-import random
-import matplotlib.pyplot as plt
-from utils import IMAGE_DIR, SAVE_PATH
+import argparse
+from annotation_store import AnnotationStore, convert_json, store_is_stale
+from utils import IMAGE_DIR, SAVE_PATH, get_output_paths
 
-with open(SAVE_PATH, "r") as f:
-    annotations = json.load(f)
-
-while True:
-
-    sample = random.choice(annotations)
-
-    # load image
-    img_path = IMAGE_DIR + sample['image']
-    image = Image.open(img_path)
+def show_sample(sample):
 
     print(f"\n + Prompt: \n{sample['prompt']}")
     print(f"\n + Initial response: \n{sample['initial_response']}\n")
@@ -27,5 +16,44 @@ while True:
 
     print("\n\t\t\t\t\t===========================================================================\n")
 
+    # PIL / matplotlib are only imported once there is an image to show, so that the text is printed right away
+    from PIL import Image
+    import matplotlib.pyplot as plt
+
+    # load image
+    img_path = IMAGE_DIR + sample['image']
+    image = Image.open(img_path)
     plt.imshow(image)
-    plt.show()
\ No newline at end of file
+    plt.show()
+
+# the annotations are read through the indexed store next to save_path (built from the JSON file on first use,
+# and rebuilt whenever the JSON file is newer, e.g. edited by hand or written with WRITE_ANNOTATION_STORE = False)
+def main(save_path=SAVE_PATH, image=None, evaluation=None):
+
+    store_path = get_output_paths(save_path)["store"]
+    if store_is_stale(store_path, save_path):
+        print(f"Building the annotation store {store_path} ...")
+        convert_json(save_path, store_path)
+
+    with AnnotationStore(store_path) as store:
+        print(store.hallucination_rates())
+
+        if image is not None:
+            for sample in store.get_by_image(image):
+                show_sample(sample)
+            return
+        if evaluation is not None:
+            for sample in store.filter_records(evaluation):
+                show_sample(sample)
+            return
+
+        while True:
+            show_sample(store.sample())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--save-path", default=SAVE_PATH)
+    parser.add_argument("--image", default=None, help="only show the samples of this image key")
+    parser.add_argument("--evaluation", default=None, help="only show the samples with a claim of this evaluation, e.g. hallucination")
+    args = parser.parse_args()
+    main(args.save_path, args.image, args.evaluation)
@@ -0,0 +1,267 @@
+"""
+indexed, memory-mapped store of the annotation results (same records as Qwen_HAL_Annotations.json)
+
+<store>/records.jsonl       one result per line, in dataset order (read through mmap, one record at a time)
+<store>/offsets.bin         byte offset of every record in records.jsonl (uint64)
+<store>/claims.jsonl        one claim text per line
+<store>/claim_offsets.bin   byte offset of every claim in claims.jsonl (uint64)
+<store>/claim_records.bin   record index of every claim (uint32)
+<store>/claim_evals.bin     evaluation code of every claim (uint8, see "evaluations" in index.json)
+<store>/index.json          counts, evaluation labels and the image key of every record
+"""
+
+import json
+import mmap
+import os
+import random
+import sys
+from array import array
+
+STORE_VERSION = 1
+
+# evaluation labels are stored lowercased, codes are assigned in order of appearance after these two
+HALLUCINATION = "hallucination"
+NON_HALLUCINATION = "non-hallucination"
+
+def normalize_evaluation(evaluation):
+    return evaluation.strip().lower()
+
+
+def _remove_store_dir(path):
+    if not os.path.isdir(path): return
+    for name in os.listdir(path):
+        os.remove(os.path.join(path, name))
+    os.rmdir(path)
+
+# True if the store is missing or older than the JSON file it was built from
+def store_is_stale(path, json_path):
+    index_path = os.path.join(path, "index.json")
+    return not os.path.exists(index_path) or os.path.getmtime(json_path) > os.path.getmtime(index_path)
+
+
+class AnnotationStoreWriter:
+    """
+    Writes the results one by one (add) and the index files on close. The store is rebuilt from scratch:
+    the files are written under a temporary name and swapped in on close (the old store is renamed aside first,
+    then removed), so readers never see a partial store.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._tmp_path = path + ".tmp"
+        os.makedirs(self._tmp_path, exist_ok=True)
+        self._records = open(os.path.join(self._tmp_path, "records.jsonl"), "wb")
+        self._claims = open(os.path.join(self._tmp_path, "claims.jsonl"), "wb")
+        self.offsets = array("Q")
+        self.claim_offsets = array("Q")
+        self.claim_records = array("I")
+        self.claim_evals = array("B")
+        self.evaluations = [NON_HALLUCINATION, HALLUCINATION]
+        self._codes = {label: code for code, label in enumerate(self.evaluations)}
+        self.images = []
+
+    def _code(self, evaluation):
+        label = normalize_evaluation(evaluation)
+        if label not in self._codes:
+            if len(self.evaluations) > 255: raise ValueError("too many distinct evaluation labels.")
+            self._codes[label] = len(self.evaluations)
+            self.evaluations.append(label)
+        return self._codes[label]
+
+    def add(self, result):
+        record_idx = len(self.offsets)
+        self.offsets.append(self._records.tell())
+        self._records.write(json.dumps(result).encode("utf-8") + b"\n")
+        self.images.append(result["image"])
+        for claim in result["evaluated_claims"]:
+            self.claim_offsets.append(self._claims.tell())
+            self._claims.write(json.dumps(claim["claim"]).encode("utf-8") + b"\n")
+            self.claim_records.append(record_idx)
+            self.claim_evals.append(self._code(claim["evaluation"]))
+
+    def close(self):
+        self._records.close()
+        self._claims.close()
+        for name, values in [("offsets.bin", self.offsets), ("claim_offsets.bin", self.claim_offsets),
+                             ("claim_records.bin", self.claim_records), ("claim_evals.bin", self.claim_evals)]:
+            with open(os.path.join(self._tmp_path, name), "wb") as f:
+                values.tofile(f)
+        index = {
+            "version": STORE_VERSION,
+            "byteorder": sys.byteorder,
+            "num_records": len(self.offsets),
+            "num_claims": len(self.claim_records),
+            "evaluations": self.evaluations,
+            "images": self.images,
+        }
+        with open(os.path.join(self._tmp_path, "index.json"), "w") as f:
+            json.dump(index, f)
+        # swap the new store in: the old one (if any) is only removed once the new one is in place
+        old_path = self.path + ".old"
+        _remove_store_dir(old_path)
+        if os.path.isdir(self.path): os.rename(self.path, old_path)
+        os.rename(self._tmp_path, self.path)
+        _remove_store_dir(old_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._records.close()
+            self._claims.close()
+
+
+# this function is to write a list of results (e.g. the compacted run output) as a store
+def write_annotation_store(results, path):
+    with AnnotationStoreWriter(path) as writer:
+        for result in results:
+            writer.add(result)
+    return path
+
+# this function is the one-time conversion of an existing Qwen_HAL_Annotations.json
+def convert_json(json_path, path):
+    with open(json_path, "r") as f:
+        results = json.load(f)
+    return write_annotation_store(results, path)
+
+
+class AnnotationStore:
+    """
+    Read-only view of a store. Records and claim texts are decoded on demand from the mmap'd files,
+    so only the fixed-size claim columns (13 bytes per claim) and the image index are held in memory.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "index.json"), "r") as f:
+            index = json.load(f)
+        if index["version"] != STORE_VERSION: raise ValueError(f"unsupported store version {index['version']}.")
+        self.num_records = index["num_records"]
+        self.num_claims = index["num_claims"]
+        self.evaluations = index["evaluations"]
+        self.images = index["images"]
+        self._image_index = {}
+        for record_idx, image in enumerate(self.images):
+            self._image_index.setdefault(image, []).append(record_idx)
+        swap = index["byteorder"] != sys.byteorder
+        self.offsets = self._read_array("offsets.bin", "Q", swap)
+        self.claim_offsets = self._read_array("claim_offsets.bin", "Q", swap)
+        self.claim_records = self._read_array("claim_records.bin", "I", swap)
+        self.claim_evals = self._read_array("claim_evals.bin", "B", swap)
+        self._records_file, self._records = self._mmap("records.jsonl")
+        self._claims_file, self._claims = self._mmap("claims.jsonl")
+
+    def _read_array(self, name, typecode, swap):
+        values = array(typecode)
+        with open(os.path.join(self.path, name), "rb") as f:
+            values.frombytes(f.read())
+        if swap: values.byteswap()
+        return values
+
+    def _mmap(self, name):
+        f = open(os.path.join(self.path, name), "rb")
+        if os.fstat(f.fileno()).st_size == 0: return f, b"" # mmap can't map an empty file
+        return f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @staticmethod
+    def _line(buffer, offsets, idx):
+        start = offsets[idx]
+        end = offsets[idx + 1] if idx + 1 < len(offsets) else len(buffer)
+        return json.loads(buffer[start:end])
+
+    def __len__(self):
+        return self.num_records
+
+    def __getitem__(self, record_idx):
+        if not 0 <= record_idx < self.num_records: raise IndexError(record_idx)
+        return self._line(self._records, self.offsets, record_idx)
+
+    def claim(self, claim_idx):
+        return self._line(self._claims, self.claim_offsets, claim_idx)
+
+    def sample(self, rng=random):
+        return self[rng.randrange(self.num_records)]
+
+    # all the records (one per prompt) of an image key, e.g. "COCO_train2014_000000123456.jpg"
+    def get_by_image(self, image):
+        return [self[record_idx] for record_idx in self._image_index.get(image, [])]
+
+    def _evaluation_code(self, evaluation):
+        label = normalize_evaluation(evaluation)
+        return self.evaluations.index(label) if label in self.evaluations else None
+
+    # yields {"record", "image", "claim", "evaluation"} for the claims with the given evaluation and / or
+    # containing the given text (case insensitive); only the matching rows are decoded
+    def filter_claims(self, evaluation=None, contains=None):
+        code = self._evaluation_code(evaluation) if evaluation is not None else None
+        if evaluation is not None and code is None: return
+        contains = contains.lower() if contains is not None else None
+        for claim_idx in range(self.num_claims):
+            if code is not None and self.claim_evals[claim_idx] != code: continue
+            text = self.claim(claim_idx)
+            if contains is not None and contains not in text.lower(): continue
+            record_idx = self.claim_records[claim_idx]
+            yield {"record": record_idx, "image": self.images[record_idx], "claim": text,
+                   "evaluation": self.evaluations[self.claim_evals[claim_idx]]}
+
+    # the records with at least one claim of the given evaluation
+    def filter_records(self, evaluation):
+        code = self._evaluation_code(evaluation)
+        if code is None: return
+        last = None
+        for claim_idx in range(self.num_claims):
+            record_idx = self.claim_records[claim_idx]
+            if self.claim_evals[claim_idx] == code and record_idx != last:
+                last = record_idx
+                yield self[record_idx]
+
+    # claim-level and response-level hallucination rates + the count of every evaluation label,
+    # computed from the claim columns only
+    def hallucination_rates(self):
+        counts = [0] * len(self.evaluations)
+        for code in self.claim_evals:
+            counts[code] += 1
+        hallucination = self.evaluations.index(HALLUCINATION)
+        flagged_records = {self.claim_records[i] for i in range(self.num_claims) if self.claim_evals[i] == hallucination}
+        return {
+            "num_records": self.num_records,
+            "num_claims": self.num_claims,
+            "claim_hallucination_rate": round(counts[hallucination] / self.num_claims, 4) if self.num_claims else 0.0,
+            "response_hallucination_rate": round(len(flagged_records) / self.num_records, 4) if self.num_records else 0.0,
+            "evaluations": dict(zip(self.evaluations, counts)),
+        }
+
+    def close(self):
+        for buffer in (self._records, self._claims):
+            if isinstance(buffer, mmap.mmap): buffer.close()
+        self._records_file.close()
+        self._claims_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+if __name__ == "__main__":
+    import argparse
+    from utils import SAVE_PATH, get_output_paths
+
+    parser = argparse.ArgumentParser(description="Build / query the indexed annotation store.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    convert_parser = subparsers.add_parser("convert", help="build the store from an annotations JSON file")
+    convert_parser.add_argument("--json-path", default=SAVE_PATH)
+    convert_parser.add_argument("--store-path", default=None)
+    stats_parser = subparsers.add_parser("stats", help="print the hallucination rates of a store")
+    stats_parser.add_argument("--store-path", default=get_output_paths(SAVE_PATH)["store"])
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        store_path = args.store_path or get_output_paths(args.json_path)["store"]
+        convert_json(args.json_path, store_path)
+        print(f"Saved to {store_path}")
+    else:
+        with AnnotationStore(args.store_path) as store:
+            print(json.dumps(store.hallucination_rates(), indent=4))
@@ -0,0 +1,621 @@
+"""
+CPU benchmarks for the Qwen HAL pipeline (no GPU / model weights needed, except for load-profiles)
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import zlib
+import argparse
+import tempfile
+
+from utils import CHARS_PER_TOKEN, IMAGE_TOKEN_ESTIMATE
+
+BENCHMARK_DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "filtered_povid.json")
+
+
+# ---------------------------
+# ---------------------------
+        # Vision cache
+# ---------------------------
+# ---------------------------
+
+def make_synthetic_jpegs(out_dir, num_images, width=640, height=480, seed=0):
+    import numpy as np
+    from PIL import Image
+    rng = np.random.default_rng(seed)
+    img_paths = []
+    for i in range(num_images):
+        pixels = rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+        img_path = os.path.join(out_dir, f"synthetic_{i:05d}.jpg")
+        Image.fromarray(pixels).save(img_path, quality=90)
+        img_paths.append(img_path)
+    return img_paths
+
+# compares decoding + preprocessing every image once per claim (as process_vision_info did) with the VisionCache
+def benchmark_vision_cache(num_images=32, claims_per_image=10, width=640, height=480, prefetch=True):
+    from transformers import Qwen2VLImageProcessor
+    from qwen_vl_utils import fetch_image
+    from qwen_wrapper import VisionCache
+
+    image_processor = Qwen2VLImageProcessor()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        img_paths = make_synthetic_jpegs(tmp_dir, num_images, width, height)
+        requests = [img_path for img_path in img_paths for _ in range(claims_per_image)] # annotation calls
+        requests += img_paths # rectification calls
+
+        start = time.perf_counter()
+        for img_path in requests:
+            image_processor(images=[fetch_image({"image": img_path})], return_tensors="pt")
+        uncached_s = time.perf_counter() - start
+
+        vision_cache = VisionCache(image_processor)
+        start = time.perf_counter()
+        if prefetch: vision_cache.prefetch(img_paths)
+        for img_path in requests:
+            vision_cache.get(img_path)
+        cached_s = time.perf_counter() - start
+
+    return {
+        "num_requests": len(requests),
+        "uncached_s": round(uncached_s, 3),
+        "cached_s": round(cached_s, 3),
+        "speedup": round(uncached_s / max(cached_s, 1e-9), 2),
+        "cache_hits": vision_cache.hits,
+        "cache_misses": vision_cache.misses,
+        "cache_mb": round(vision_cache.num_bytes / 1024 ** 2, 1),
+    }
+
+
+# ---------------------------
+# ---------------------------
+        # Tiny model checks
+# ---------------------------
+# ---------------------------
+
+# tiny random-weight Llama (CPU, float32) for the output equality checks below; token ids 0 / 1 / 2 are pad / bos / eos
+def make_tiny_llama(max_positions, hidden_size=64, num_layers=2, vocab_size=1024, seed=0):
+    import torch
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    torch.manual_seed(seed)
+    config = LlamaConfig(
+        vocab_size=vocab_size, hidden_size=hidden_size, intermediate_size=4 * hidden_size,
+        num_hidden_layers=num_layers, num_attention_heads=4, num_key_value_heads=4,
+        max_position_embeddings=max_positions, pad_token_id=0, bos_token_id=1, eos_token_id=2)
+    return LlamaForCausalLM(config).eval()
+
+# small byte-level BPE trained on the given texts (ids 0 / 1 / 2 / 3 are pad / bos / eos / unk, as in make_tiny_llama),
+# with a plain "role: content" chat template --> lets the wrappers run on a tiny model without downloading a tokenizer
+def make_bpe_tokenizer(texts, vocab_size=1024):
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import PreTrainedTokenizerFast
+
+    backend = Tokenizer(models.BPE())
+    backend.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    backend.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=vocab_size, special_tokens=["[PAD]", "[BOS]", "[EOS]", "[UNK]"], initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+    backend.train_from_iterator(texts, trainer)
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=backend, pad_token="[PAD]", bos_token="[BOS]", eos_token="[EOS]", unk_token="[UNK]")
+    tokenizer.chat_template = (
+        "{% for message in messages %}{{ message['role'] }}: {{ message['content'] }}\n{% endfor %}"
+        "{% if add_generation_prompt %}assistant:{% endif %}")
+    tokenizer.padding_side = "left"
+    return tokenizer
+
+# compares extract_claims_batch on one caption at a time and on batches of batch_size, with the LLM wrapper running a
+# tiny float32 model: both must return the same fact lists (in bf16, left padding changes the low bits of the logits,
+# so a near-tie between two tokens can still resolve differently in a batch)
+def benchmark_batched_extraction(num_contents=8, batch_size=4, data_path=BENCHMARK_DATA_PATH, seed=0):
+    from qwen_wrapper import Qwen_2_5_LLM_7B_Instruct, get_claim_extraction_prompt
+
+    with open(data_path, "r") as f:
+        contents = [entry["initial_response"] for entry in json.load(f)[:num_contents]]
+    tokenizer = make_bpe_tokenizer([get_claim_extraction_prompt(content) for content in contents])
+    max_prompt_tokens = max(len(tokenizer(get_claim_extraction_prompt(content)).input_ids) for content in contents)
+    model = make_tiny_llama(max_prompt_tokens + 2048 + 64, vocab_size=len(tokenizer), seed=seed)
+    model.generation_config.do_sample = False
+
+    qwen_llm = Qwen_2_5_LLM_7B_Instruct(use_prompt_lookup=False, load_profile="cpu")
+    qwen_llm._tokenizer, qwen_llm._model = tokenizer, model
+    start = time.perf_counter()
+    single = [qwen_llm.extract_claims_batch([content])[0] for content in contents]
+    single_s = time.perf_counter() - start
+    start = time.perf_counter()
+    batched = qwen_llm.extract_claims_batch(contents, batch_size=batch_size)
+    batched_s = time.perf_counter() - start
+    return {
+        "num_contents": num_contents,
+        "batch_size": batch_size,
+        "mismatches": sum(a != b for a, b in zip(single, batched)),
+        "single_s": round(single_s, 3),
+        "batched_s": round(batched_s, 3),
+        "speedup": round(single_s / max(batched_s, 1e-9), 3),
+    }
+
+# compares score_first_tokens on left padded batches with a forward pass over each (unpadded) prompt alone, on a tiny model:
+# the candidate logits must match to atol, and so must the preferred candidate
+def benchmark_first_token_scores(num_prompts=32, batch_size=8, max_prompt_tokens=256, num_candidates=2, vocab_size=1024, seed=0, atol=1e-4):
+    import torch
+    from qwen_wrapper import score_first_tokens
+
+    model = make_tiny_llama(max_prompt_tokens + 16, vocab_size=vocab_size, seed=seed)
+    candidate_token_ids = list(range(3, 3 + num_candidates))
+    prompts = [torch.randint(3, vocab_size, (int(torch.randint(max_prompt_tokens // 4, max_prompt_tokens + 1, ())),)) for _ in range(num_prompts)]
+    single_s, batched_s, max_abs_diff, mismatches = 0.0, 0.0, 0.0, 0
+    for start in range(0, num_prompts, batch_size):
+        batch = prompts[start:start + batch_size]
+        start_time = time.perf_counter()
+        with torch.no_grad():
+            expected = torch.stack([model(input_ids=prompt.view(1, -1)).logits[0, -1, candidate_token_ids] for prompt in batch])
+        single_s += time.perf_counter() - start_time
+        length = max(len(prompt) for prompt in batch)
+        input_ids = torch.stack([torch.cat([torch.zeros(length - len(prompt), dtype=prompt.dtype), prompt]) for prompt in batch])
+        attention_mask = torch.stack([torch.cat([torch.zeros(length - len(prompt), dtype=torch.long), torch.ones(len(prompt), dtype=torch.long)]) for prompt in batch])
+        start_time = time.perf_counter()
+        scores = score_first_tokens(model, {"input_ids": input_ids, "attention_mask": attention_mask}, candidate_token_ids)
+        batched_s += time.perf_counter() - start_time
+        diff = (scores - expected).abs().max(dim=1).values
+        max_abs_diff = max(max_abs_diff, float(diff.max()))
+        mismatches += int(((diff > atol) | (scores.argmax(dim=1) != expected.argmax(dim=1))).sum())
+    return {
+        "num_prompts": num_prompts,
+        "mismatches": mismatches,
+        "max_abs_diff": max_abs_diff,
+        "single_s": round(single_s, 3),
+        "batched_s": round(batched_s, 3),
+    }
+
+# compares greedy model.generate on each full (prefix + suffix) prompt with generate_with_prefix_cache on a tiny model:
+# both must return the same tokens
+def benchmark_prefix_cache(num_prefixes=4, suffixes_per_prefix=8, prefix_tokens=256, suffix_tokens=16, max_new_tokens=32, vocab_size=1024, seed=0):
+    import torch
+    from qwen_wrapper import generate_with_prefix_cache
+
+    model = make_tiny_llama(prefix_tokens + suffix_tokens + max_new_tokens + 16, vocab_size=vocab_size, seed=seed)
+    generate_kwargs = {"do_sample": False, "max_new_tokens": max_new_tokens, "pad_token_id": 0}
+    uncached_s, cached_s, mismatches = 0.0, 0.0, 0
+    for _ in range(num_prefixes):
+        prefix_ids = torch.randint(3, vocab_size, (1, prefix_tokens))
+        suffixes = [torch.randint(3, vocab_size, (suffix_tokens,)).tolist() for _ in range(suffixes_per_prefix)]
+        start = time.perf_counter()
+        expected = []
+        with torch.no_grad():
+            for suffix in suffixes:
+                input_ids = torch.cat([prefix_ids, torch.tensor([suffix])], dim=1)
+                expected.append(model.generate(input_ids=input_ids, attention_mask=torch.ones_like(input_ids), **generate_kwargs)[0, input_ids.shape[1]:].tolist())
+        uncached_s += time.perf_counter() - start
+        start = time.perf_counter()
+        generated = generate_with_prefix_cache(model, {"input_ids": prefix_ids, "attention_mask": torch.ones_like(prefix_ids)}, suffixes, **generate_kwargs)
+        cached_s += time.perf_counter() - start
+        mismatches += sum(output.tolist() != tokens for output, tokens in zip(generated, expected))
+    return {
+        "num_prompts": num_prefixes * suffixes_per_prefix,
+        "mismatches": mismatches,
+        "uncached_s": round(uncached_s, 3),
+        "prefix_cached_s": round(cached_s, 3),
+        "speedup": round(uncached_s / max(cached_s, 1e-9), 3),
+    }
+
+# compares greedy model.generate with generate_with_prompt_lookup on a tiny model: both must return the same tokens;
+# each prompt holds a "source" span twice, as a rectification prompt holds the initial response
+def benchmark_prompt_lookup(num_prompts=8, source_tokens=128, max_new_tokens=128, hidden_size=64, num_layers=2, vocab_size=1024, seed=0):
+    import torch
+    from qwen_wrapper import generate_with_prompt_lookup
+
+    model = make_tiny_llama(4 * source_tokens + max_new_tokens + 16, hidden_size, num_layers, vocab_size, seed)
+
+    greedy_s, lookup_s, drafted, accepted, mismatches = 0.0, 0.0, 0, 0, 0
+    for _ in range(num_prompts):
+        source = torch.randint(3, vocab_size, (source_tokens,))
+        input_ids = torch.cat([torch.randint(3, vocab_size, (source_tokens // 2,)), source, torch.randint(3, vocab_size, (8,)), source[:4]]).view(1, -1)
+        inputs = {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+        start = time.perf_counter()
+        with torch.no_grad():
+            expected = model.generate(**inputs, do_sample=False, max_new_tokens=max_new_tokens, pad_token_id=0)[0, input_ids.shape[1]:].tolist()
+        greedy_s += time.perf_counter() - start
+        start = time.perf_counter()
+        generated, stats = generate_with_prompt_lookup(model, inputs, max_new_tokens=max_new_tokens)
+        lookup_s += time.perf_counter() - start
+        drafted += stats["drafted"]
+        accepted += stats["accepted"]
+        mismatches += generated != expected
+    return {
+        "num_prompts": num_prompts,
+        "mismatches": mismatches,
+        "acceptance_rate": round(accepted / drafted, 4) if drafted else 0.0,
+        "greedy_s": round(greedy_s, 3),
+        "prompt_lookup_s": round(lookup_s, 3),
+        "speedup": round(greedy_s / max(lookup_s, 1e-9), 3),
+    }
+
+
+# ---------------------------
+# ---------------------------
+        # Load profiles
+# ---------------------------
+# ---------------------------
+
+# this function is to load the Qwen LLM with each load profile and extract the claims of num_prompts POVID responses:
+# load time, weight footprint, peak memory of the load and of generation, and generate throughput per profile
+# (unlike the other benchmarks, this one needs the real weights; the GPU profiles also need a GPU)
+def benchmark_load_profiles(profiles=None, num_prompts=8, data_path=BENCHMARK_DATA_PATH):
+    from qwen_wrapper import LOAD_PROFILES, Qwen_2_5_LLM_7B_Instruct
+    from tracing import TRACER
+
+    with open(data_path, "r") as f:
+        responses = [entry["initial_response"] for entry in json.load(f)[:num_prompts]]
+    results = {}
+    for profile in profiles or LOAD_PROFILES:
+        qwen_llm = Qwen_2_5_LLM_7B_Instruct(use_prompt_lookup=False, load_profile=profile)
+        TRACER.reset()
+        try:
+            qwen_llm.model
+            qwen_llm.extract_claims_batch(responses)
+        except (ValueError, ImportError, RuntimeError) as error: # no GPU, bitsandbytes missing, ...
+            results[profile] = {"error": repr(error)}
+            continue
+        finally:
+            qwen_llm.unload()
+        spans = TRACER.summary()
+        load, generate = spans["llm.load_model"], spans["llm.generate"]
+        results[profile] = {
+            "load_s": load["total_s"],
+            "footprint_mb": load["sum_footprint_mb"],
+            "load_peak_memory_mb": load["peak_memory_mb"],
+            "generate_s": generate["total_s"],
+            "output_tokens": generate["sum_output_tokens"],
+            "output_tokens_per_s": round(generate["sum_output_tokens"] / max(generate["total_s"], 1e-9), 2),
+            "generate_peak_memory_mb": generate["peak_memory_mb"],
+        }
+    return results
+
+
+# ---------------------------
+# ---------------------------
+        # Fake Qwen backends
+# ---------------------------
+# ---------------------------
+
+def num_tokens(text):
+    return max(len(text) // CHARS_PER_TOKEN, 1)
+
+# deterministic 25% of the claims are "hallucinations"
+def stub_is_hallucination(claim):
+    return zlib.crc32(claim.encode("utf-8")) % 4 == 0
+
+class StubBackend:
+    """
+    Deterministic stand-in for a Qwen wrapper: outputs are derived from the inputs, and the compute is simulated
+    by sleeping prefill_latency per (batch) input token + decode_latency per decoding step of the longest output,
+    which is how a batched generate call on a GPU behaves.
+    """
+    def __init__(self, prefill_latency=2e-6, decode_latency=1e-3):
+        self.prefill_latency = prefill_latency
+        self.decode_latency = decode_latency
+
+    # one call = one batched generate over prompts with these token counts
+    def _run(self, input_tokens, output_tokens):
+        from tracing import TRACER
+        with TRACER.span(f"{self.model_name}.generate", batch_size=len(input_tokens), input_tokens=sum(input_tokens), output_tokens=sum(output_tokens)):
+            self._simulate(input_tokens, output_tokens)
+
+    def _simulate(self, input_tokens, output_tokens):
+        time.sleep(self.prefill_latency * sum(input_tokens) + self.decode_latency * max(output_tokens, default=0))
+
+
+class StubLLM(StubBackend):
+    model_name = "stub/llm"
+
+    def get_response(self, query):
+        self._run([num_tokens(query)], [num_tokens(query)])
+        return query
+
+    # one fact per sentence / comma-separated clause
+    def _facts(self, content):
+        clauses = [c.strip().strip(".") for c in re.split(r"[.!?]|, (?:and |while |with )?", content)]
+        return [c[0].upper() + c[1:] + "." for c in clauses if len(c.split()) >= 3]
+
+    def extract_claims(self, content):
+        return self.extract_claims_batch([content])[0]
+
+    def extract_claims_batch(self, contents):
+        from qwen_wrapper import get_claim_extraction_prompt
+        facts = [self._facts(content) for content in contents]
+        self._run([num_tokens(get_claim_extraction_prompt(c)) for c in contents], [sum(num_tokens(f) + 8 for f in fs) for fs in facts])
+        return facts
+
+
+class StubVLM(StubBackend):
+    model_name = "stub/vlm"
+
+    def prefetch_images(self, img_paths):
+        pass
+
+    def _annotation(self, query):
+        claim = re.findall(r"\[STATEMENT\]: (.*)", query)[-1]
+        if stub_is_hallucination(claim):
+            return f"[STATEMENT]: {claim}\n[EVALUATION]: hallucination\n[REASON]: The image does not show that {claim[0].lower() + claim[1:]}"
+        return f"[STATEMENT]: {claim}\n[EVALUATION]: non-hallucination\n[REASON]: The image supports this statement."
+
+    # the "rectified" response drops the flagged claims' sentences from the initial description
+    def _rectification(self, query):
+        initial = re.search(r"---\n(.*?)\n---\n\nThe annotations are as follows", query, flags=re.DOTALL).group(1).strip()
+        flagged = re.findall(r"\[STATEMENT \d+\]: (.*)\n\[EVALUATION \d+\]: hallucination", query)
+        sentences = [s for s in re.split(r"(?<=[.!?]) ", initial) if not any(f.rstrip(".") in s for f in flagged)]
+        return " ".join(sentences)
+
+    def _respond(self, query, answer_prefix=None):
+        if "[STATEMENT]:" in query:
+            response = self._annotation(query)
+        else:
+            response = self._rectification(query)
+        if answer_prefix is not None:
+            # continue the prefilled answer
+            response = response[len(answer_prefix):] if response.startswith(answer_prefix) else " " + response.split("[REASON]:")[-1].strip()
+        return response
+
+    def get_response(self, img_path, query):
+        return self.get_batch_response([img_path], [query])[0]
+
+    def get_batch_response(self, img_paths, queries, answer_prefixes=None):
+        if len(img_paths) != len(queries): raise ValueError("img_paths and queries must have the same length.")
+        answer_prefixes = answer_prefixes or [None] * len(queries)
+        responses = [self._respond(q, a) for q, a in zip(queries, answer_prefixes)]
+        self._run([num_tokens(q) + IMAGE_TOKEN_ESTIMATE for q in queries], [num_tokens(r) for r in responses])
+        return responses
+
+    def get_prefix_cached_responses(self, img_path, prefix_query, suffix_queries):
+        responses = [self._respond(prefix_query + q) for q in suffix_queries]
+        # prefix encoded once, then one batch-1 decode per suffix
+        self._run([num_tokens(prefix_query) + IMAGE_TOKEN_ESTIMATE], [])
+        for q, r in zip(suffix_queries, responses):
+            self._run([num_tokens(q)], [num_tokens(r)])
+        return responses
+
+    def get_prompt_lookup_responses(self, img_paths, queries):
+        return self.get_batch_response(img_paths, queries)
+
+    def get_candidate_logits(self, img_paths, queries, answer_prefixes, candidates):
+        self._run([num_tokens(q) + IMAGE_TOKEN_ESTIMATE for q in queries], [])
+        return [[2.0, -2.0] if stub_is_hallucination(re.findall(r"\[STATEMENT\]: (.*)", a)[-1]) else [-2.0, 2.0] for a in answer_prefixes]
+
+
+class TinyTransformerBackend:
+    """
+    Mixin that replaces the simulated latency of a stub with a real (tiny, random-weight) Llama forward / generate on CPU:
+    each call runs one left-padded batched generate with the same input / output token counts as the real model would.
+    Texts still come from the stub, since a random model only produces noise.
+    """
+    def __init__(self, hidden_size=64, num_layers=2, vocab_size=1024, max_input_tokens=1024, seed=0):
+        self.model = make_tiny_llama(max_input_tokens + 4096, hidden_size, num_layers, vocab_size, seed)
+        self.max_input_tokens = max_input_tokens
+
+    def _simulate(self, input_tokens, output_tokens):
+        import torch
+        input_tokens = [min(n, self.max_input_tokens) for n in input_tokens]
+        max_input, max_output = max(input_tokens), max(output_tokens, default=0)
+        vocab_size = self.model.config.vocab_size
+        input_ids = torch.zeros(len(input_tokens), max_input, dtype=torch.long)
+        attention_mask = torch.zeros_like(input_ids)
+        for i, n in enumerate(input_tokens):
+            input_ids[i, max_input - n:] = torch.randint(3, vocab_size, (n,))
+            attention_mask[i, max_input - n:] = 1
+        with torch.no_grad():
+            if max_output == 0:
+                self.model(input_ids=input_ids, attention_mask=attention_mask, logits_to_keep=1)
+            else:
+                self.model.generate(input_ids=input_ids, attention_mask=attention_mask, do_sample=False,
+                                    min_new_tokens=max_output, max_new_tokens=max_output, pad_token_id=0)
+
+class TinyLLM(TinyTransformerBackend, StubLLM):
+    model_name = "tiny/llm"
+
+class TinyVLM(TinyTransformerBackend, StubVLM):
+    model_name = "tiny/vlm"
+
+# prefill / decode latencies are only used by the stub backends
+def make_backends(backend, prefill_latency=2e-6, decode_latency=1e-3):
+    if backend == "stub": return StubLLM(prefill_latency, decode_latency), StubVLM(prefill_latency, decode_latency)
+    if backend == "tiny": return TinyLLM(), TinyVLM()
+    raise ValueError(f"unknown backend {backend}")
+
+
+# ---------------------------
+# ---------------------------
+        # End-to-end pipeline
+# ---------------------------
+# ---------------------------
+
+# this function is to run qwen_HAL_annotator.main() end-to-end on fake backends and report its throughput
+def benchmark_pipeline(backend="stub", num_samples=200, data_path=BENCHMARK_DATA_PATH, use_pipeline=True, prefill_latency=2e-6, decode_latency=1e-3, **main_kwargs):
+    import qwen_HAL_annotator
+    from tracing import TRACER
+
+    qwen_llm, qwen_vlm = make_backends(backend, prefill_latency, decode_latency)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        summary = qwen_HAL_annotator.main(
+            qwen_llm=qwen_llm, qwen_vlm=qwen_vlm,
+            data_path=data_path, save_path=os.path.join(tmp_dir, "annotations.json"),
+            resume=False, use_pipeline=use_pipeline, use_cache=False, limit=num_samples, **main_kwargs)
+    spans = TRACER.summary()
+    wall_s = max(summary["wall_s"], 1e-9)
+    return {
+        "backend": backend,
+        "use_pipeline": use_pipeline,
+        "num_samples": summary["num_entries"],
+        "num_claims": summary["num_claims"],
+        "wall_s": summary["wall_s"],
+        "samples_per_s": round(summary["num_entries"] / wall_s, 3),
+        "claims_per_s": round(summary["num_claims"] / wall_s, 3),
+        # per pipeline stage (one call per chunk) and per backend generate call
+        "latency_ms": {
+            name: {k: stats[k] for k in ("count", "p50_ms", "p95_ms", "p99_ms", "max_ms")}
+            for name, stats in spans.items() if name.startswith("stage.") or name.endswith(".generate")
+        },
+    }
+
+
+# this function is to check the out of memory backoff of AdaptiveBatcher on CPU, with injected failures above
+# oom_above tokens: results in input order, OOMs split and learnt (the next runs on the same batcher don't fail again),
+# a single request that still fails is re-raised, and so is an error that is not an out of memory
+def check_oom_backoff(num_requests=64, max_length=512, oom_above=2048, seed=0):
+    import random
+    from qwen_wrapper import AdaptiveBatcher, inject_oom_above
+
+    rng = random.Random(seed)
+    lengths = [rng.randint(16, max_length) for _ in range(num_requests)]
+    inject, failed_tokens = inject_oom_above(oom_above), []
+    def fault_hook(batch_size, batch_tokens):
+        if batch_tokens > oom_above: failed_tokens.append(batch_tokens)
+        inject(batch_size, batch_tokens)
+    batcher = AdaptiveBatcher(max_batch_tokens=None, fault_hook=fault_hook)
+    failures, num_ooms = [], []
+    for run in range(3):
+        before = batcher.num_ooms
+        results = batcher.run(lengths, lambda batch: [("done", i) for i in batch])
+        num_ooms.append(batcher.num_ooms - before)
+        if results != [("done", i) for i in range(num_requests)]: failures.append(f"run {run}: results not in input order")
+    if num_ooms[0] == 0: failures.append("the first run had no out of memory to back off from")
+    if num_ooms[-1] != 0: failures.append(f"the budget was not learnt: {num_ooms[-1]} out of memory in the last run")
+    # every failed batch halves the budget
+    expected = min(failed_tokens) // 2 if failed_tokens else None
+    if batcher.safe_batch_tokens != expected: failures.append(f"safe_batch_tokens {batcher.safe_batch_tokens}, expected {expected}")
+
+    try:
+        AdaptiveBatcher(fault_hook=inject_oom_above(oom_above)).run([oom_above + 1], lambda batch: [None] * len(batch))
+        failures.append("a single request over the budget was not re-raised")
+    except RuntimeError:
+        pass
+    def not_oom(batch):
+        raise ValueError("bad request")
+    splits = AdaptiveBatcher()
+    try:
+        splits.run(lengths, not_oom)
+        failures.append("an error that is not an out of memory was swallowed")
+    except ValueError:
+        if splits.num_ooms: failures.append("an error that is not an out of memory was retried")
+    return {"num_requests": num_requests, "num_ooms_per_run": num_ooms, "safe_batch_tokens": batcher.safe_batch_tokens, "failures": failures}
+
+# this function is to check how the StagePipeline behaves when a stage raises while earlier items are still in later
+# stages: the error must come out, every yielded item must have gone through every stage (in input order), and no
+# thread may be left; each case fails one stage on one item
+def check_pipeline_failure(num_items=8, stage_delay_s=0.02, cases=((0, 2), (1, 3), (2, 1), (0, 0))):
+    import threading
+    from qwen_HAL_annotator import Stage, StagePipeline
+
+    class InjectedFailure(Exception):
+        pass
+
+    def make_stage(stage_idx, fail_stage, fail_item):
+        def fn(item):
+            if stage_idx == fail_stage and item[0] == fail_item: raise InjectedFailure(item[0])
+            time.sleep(stage_delay_s * stage_idx) # later stages are slower, so earlier items are still in them
+            return item + (stage_idx,)
+        return fn
+
+    failures = []
+    for fail_stage, fail_item in cases:
+        base_threads = threading.active_count()
+        pipeline = StagePipeline([Stage(f"s{i}", make_stage(i, fail_stage, fail_item)) for i in range(3)])
+        outputs, raised = [], False
+        try:
+            for output in pipeline.run([(i,) for i in range(num_items)]):
+                outputs.append(output)
+        except InjectedFailure:
+            raised = True
+        case = f"stage {fail_stage} fails on item {fail_item}"
+        if not raised: failures.append(f"{case}: the error was not raised")
+        if [output[0] for output in outputs] != list(range(len(outputs))): failures.append(f"{case}: outputs out of order")
+        if any(output[1:] != (0, 1, 2) for output in outputs): failures.append(f"{case}: yielded an item that skipped a stage")
+        if any(output[0] >= fail_item for output in outputs): failures.append(f"{case}: yielded an item after the failed one")
+        if threading.active_count() != base_threads: failures.append(f"{case}: threads left running")
+    return {"num_cases": len(cases), "failures": failures}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    pipeline_parser = subparsers.add_parser("pipeline", help="end-to-end qwen_HAL_annotator.main() on fake backends")
+    pipeline_parser.add_argument("--backend", choices=["stub", "tiny"], default="stub")
+    pipeline_parser.add_argument("--num-samples", type=int, default=200)
+    pipeline_parser.add_argument("--data-path", default=BENCHMARK_DATA_PATH)
+    pipeline_parser.add_argument("--no-pipeline", action="store_true")
+    pipeline_parser.add_argument("--prefill-latency", type=float, default=2e-6, help="stub seconds per input token")
+    pipeline_parser.add_argument("--decode-latency", type=float, default=1e-3, help="stub seconds per decoding step")
+    pipeline_parser.add_argument("--min-samples-per-s", type=float, default=None, help="exit with an error below this throughput")
+    pipeline_parser.add_argument("--output", default=None, help="also write the results to this JSON file")
+
+    vision_parser = subparsers.add_parser("vision-cache", help="image decode / preprocess with and without the VisionCache")
+    vision_parser.add_argument("--num-images", type=int, default=32)
+    vision_parser.add_argument("--claims-per-image", type=int, default=10)
+    vision_parser.add_argument("--no-prefetch", action="store_true")
+
+    lookup_parser = subparsers.add_parser("prompt-lookup", help="greedy generate vs prompt lookup decoding on a tiny CPU model")
+    lookup_parser.add_argument("--num-prompts", type=int, default=8)
+    lookup_parser.add_argument("--source-tokens", type=int, default=128)
+    lookup_parser.add_argument("--max-new-tokens", type=int, default=128)
+
+    profiles_parser = subparsers.add_parser("load-profiles", help="load time / memory / generate throughput of each load profile (real weights)")
+    profiles_parser.add_argument("--profiles", nargs="+", default=None)
+    profiles_parser.add_argument("--num-prompts", type=int, default=8)
+
+    prefix_parser = subparsers.add_parser("prefix-cache", help="generate vs generate_with_prefix_cache on a tiny CPU model")
+    prefix_parser.add_argument("--num-prefixes", type=int, default=4)
+    prefix_parser.add_argument("--suffixes-per-prefix", type=int, default=8)
+    prefix_parser.add_argument("--prefix-tokens", type=int, default=256)
+
+    extraction_parser = subparsers.add_parser("batched-extraction", help="extract_claims_batch alone vs in batches on a tiny CPU model")
+    extraction_parser.add_argument("--num-contents", type=int, default=8)
+    extraction_parser.add_argument("--batch-size", type=int, default=4)
+
+    scores_parser = subparsers.add_parser("first-token-scores", help="score_first_tokens on padded batches vs each prompt alone on a tiny CPU model")
+    scores_parser.add_argument("--num-prompts", type=int, default=32)
+    scores_parser.add_argument("--batch-size", type=int, default=8)
+
+    oom_parser = subparsers.add_parser("oom-backoff", help="AdaptiveBatcher with injected out of memory errors (CPU)")
+    oom_parser.add_argument("--num-requests", type=int, default=64)
+    oom_parser.add_argument("--oom-above", type=int, default=2048, help="batches above this many prefill tokens fail")
+    subparsers.add_parser("pipeline-failure", help="StagePipeline with a stage raising while earlier items are in later stages")
+    args = parser.parse_args()
+
+    if args.benchmark == "oom-backoff":
+        results = check_oom_backoff(args.num_requests, oom_above=args.oom_above)
+        print(json.dumps(results, indent=4))
+        if results["failures"]: sys.exit(f"{len(results['failures'])} out of memory backoff check(s) failed")
+    elif args.benchmark == "pipeline-failure":
+        results = check_pipeline_failure()
+        print(json.dumps(results, indent=4))
+        if results["failures"]: sys.exit(f"{len(results['failures'])} pipeline failure case(s) misbehaved")
+    elif args.benchmark == "load-profiles":
+        print(json.dumps(benchmark_load_profiles(args.profiles, args.num_prompts), indent=4))
+    elif args.benchmark == "batched-extraction":
+        results = benchmark_batched_extraction(args.num_contents, args.batch_size)
+        print(json.dumps(results, indent=4))
+        if results["mismatches"]: sys.exit(f"{results['mismatches']} caption(s) get different facts in a batch")
+    elif args.benchmark == "first-token-scores":
+        results = benchmark_first_token_scores(args.num_prompts, args.batch_size)
+        print(json.dumps(results, indent=4))
+        if results["mismatches"]: sys.exit(f"{results['mismatches']} prompt(s) get different candidate logits in a batch")
+    elif args.benchmark == "prefix-cache":
+        results = benchmark_prefix_cache(args.num_prefixes, args.suffixes_per_prefix, args.prefix_tokens)
+        print(json.dumps(results, indent=4))
+        if results["mismatches"]: sys.exit(f"{results['mismatches']} prompt(s) differ from the uncached generate")
+    elif args.benchmark == "prompt-lookup":
+        results = benchmark_prompt_lookup(args.num_prompts, args.source_tokens, args.max_new_tokens)
+        print(json.dumps(results, indent=4))
+        if results["mismatches"]: sys.exit(f"{results['mismatches']} prompt(s) differ from greedy decoding")
+    elif args.benchmark == "vision-cache":
+        results = benchmark_vision_cache(args.num_images, args.claims_per_image, prefetch=not args.no_prefetch)
+        print(json.dumps(results, indent=4))
+    else:
+        results = benchmark_pipeline(args.backend, args.num_samples, args.data_path, not args.no_pipeline, args.prefill_latency, args.decode_latency)
+        print(json.dumps(results, indent=4))
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=4)
+        if args.min_samples_per_s is not None and results["samples_per_s"] < args.min_samples_per_s:
+            sys.exit(f"throughput regression: {results['samples_per_s']} samples/s < {args.min_samples_per_s}")
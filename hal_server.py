@@ -0,0 +1,323 @@
+"""
+asyncio front end of the HAL detector: (image, response) requests from concurrent callers are batched together
+at every stage (claim extraction, annotation, rectification), and each caller gets a stream of events
+(extracted claims, one verdict per claim, final result) as soon as they are ready
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from qwen_HAL_annotator import new_work, extract_chunk_claims, annotate_chunk, rectify_chunk, build_final_result, ClaimDedupIndex
+from utils import IMAGE_DIR, DEDUP_CLAIMS, SERVE_MAX_BATCH_ENTRIES, SERVE_MAX_WAIT_S, SERVE_HOST, SERVE_PORT
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class _Request:
+    def __init__(self, work, deadline):
+        self.work = work
+        self.deadline = deadline # loop time, or None
+        self.events = asyncio.Queue()
+        self.cancelled = False
+
+    def active(self, now):
+        return not self.cancelled and (self.deadline is None or now < self.deadline)
+
+
+class HalDetectionService:
+    """
+    Continuous batching across callers: each stage takes every request waiting for it (up to max_batch_entries,
+    waiting at most max_wait_s for more to arrive), runs the existing chunk function on the whole batch, and hands
+    the requests to the next stage. The next batch of a stage forms while the current one runs, so new requests
+    join at the next stage boundary instead of waiting for the previous ones to finish.
+    The LLM stage and the VLM stages (which take turns on the VLM) run on their own threads, so extraction of
+    new requests overlaps with annotation / rectification of older ones.
+    Cancelled or expired requests are dropped before their next stage.
+    Claims are deduplicated within each annotation batch only: a long-lived index would grow with every request
+    and, being keyed on the image path, keep answering for an image file replaced at the same path.
+    """
+    def __init__(self, qwen_llm, qwen_vlm, cache=None, max_batch_entries=SERVE_MAX_BATCH_ENTRIES, max_wait_s=SERVE_MAX_WAIT_S, image_dir=IMAGE_DIR):
+        self.qwen_llm = qwen_llm
+        self.qwen_vlm = qwen_vlm
+        self.cache = cache
+        self.dedup = DEDUP_CLAIMS
+        self.dedup_stats = {"claims": 0, "saved_calls": 0}
+        self.max_batch_entries = max_batch_entries
+        self.max_wait_s = max_wait_s
+        self.image_dir = image_dir
+        self.num_batches = {"extract": 0, "annotate": 0, "rectify": 0}
+        self._tasks = []
+
+    async def start(self):
+        self._llm_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="hal-llm")
+        self._vlm_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="hal-vlm")
+        self._extract_q, self._annotate_q, self._rectify_q = asyncio.Queue(), asyncio.Queue(), asyncio.Queue()
+        self._tasks = [
+            asyncio.create_task(self._stage_loop("extract", self._extract_q, self._extract, self._llm_executor, self._annotate_q)),
+            asyncio.create_task(self._stage_loop("annotate", self._annotate_q, self._annotate, self._vlm_executor, self._rectify_q)),
+            asyncio.create_task(self._stage_loop("rectify", self._rectify_q, self._rectify, self._vlm_executor, None)),
+        ]
+        return self
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._llm_executor.shutdown(wait=True)
+        self._vlm_executor.shutdown(wait=True)
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    # ---- stages (run on the executor threads) ----
+
+    def _extract(self, works):
+        extract_chunk_claims(self.qwen_llm, works, self.cache)
+
+    def _annotate(self, works):
+        dedup = ClaimDedupIndex() if self.dedup else None
+        annotate_chunk(self.qwen_vlm, works, cache=self.cache, dedup=dedup)
+        if dedup is not None:
+            self.dedup_stats["claims"] += dedup.num_claims
+            self.dedup_stats["saved_calls"] += dedup.num_reused
+
+    def _rectify(self, works):
+        rectify_chunk(self.qwen_vlm, works, self.cache)
+
+    # events sent to the caller once a stage is done with its request
+    @staticmethod
+    def _stage_events(name, work):
+        if name == "extract":
+            return [{"type": "claims", "claims": work["statements"]}]
+        if name == "annotate":
+            events = []
+            for i, claim in enumerate(work["statements"]):
+                event = {"type": "verdict", "index": i, "claim": claim, "evaluation": work["evaluations"][i], "reason": work["reasons"][i]}
+                if work["hallucination_probs"][i] is not None: event["hallucination_prob"] = work["hallucination_probs"][i]
+                events.append(event)
+            return events
+        return [{"type": "result", "result": build_final_result(work)}]
+
+    async def _next_batch(self, queue):
+        batch = [await queue.get()]
+        loop = asyncio.get_running_loop()
+        end = loop.time() + self.max_wait_s
+        while len(batch) < self.max_batch_entries:
+            if not queue.empty():
+                batch.append(queue.get_nowait())
+                continue
+            remaining = end - loop.time()
+            if remaining <= 0: break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _stage_loop(self, name, in_q, fn, executor, out_q):
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = [request for request in await self._next_batch(in_q) if request.active(loop.time())]
+            if not requests: continue
+            self.num_batches[name] += 1
+            try:
+                await loop.run_in_executor(executor, fn, [request.work for request in requests])
+            except Exception as error:
+                for request in requests:
+                    request.events.put_nowait({"type": "error", "error": f"{name}: {error!r}"})
+                continue
+            for request in requests:
+                for event in self._stage_events(name, request.work):
+                    request.events.put_nowait(event)
+                if out_q is not None: out_q.put_nowait(request)
+
+    # ---- public API ----
+
+    # the image keys come from the callers: only files inside image_dir are served (no absolute paths / "..")
+    def image_path(self, image):
+        root = os.path.realpath(self.image_dir)
+        img_path = os.path.join(self.image_dir, image)
+        if os.path.commonpath([root, os.path.realpath(img_path)]) != root: raise ValueError(f"image {image!r} is outside the image directory.")
+        return img_path
+
+    # async generator of the events of one request: "claims", then one "verdict" per claim, then "result"
+    # (or a single "error"); deadline_s bounds the whole request, and closing the generator cancels it
+    async def detect(self, image, response, prompt="", deadline_s=None):
+        if not self._tasks: raise RuntimeError("the service is not started.")
+        loop = asyncio.get_running_loop()
+        work = new_work({"image": image, "prompt": prompt, "initial_response": response})
+        work["img_path"] = self.image_path(image)
+        request = _Request(work, loop.time() + deadline_s if deadline_s is not None else None)
+        # off the event loop: the first call loads the processor
+        await loop.run_in_executor(None, self.qwen_vlm.prefetch_images, [work["img_path"]])
+        self._extract_q.put_nowait(request)
+        try:
+            while True:
+                timeout = request.deadline - loop.time() if request.deadline is not None else None
+                try:
+                    event = await asyncio.wait_for(request.events.get(), timeout)
+                except asyncio.TimeoutError:
+                    yield {"type": "error", "error": "deadline exceeded"}
+                    return
+                yield event
+                if event["type"] in ("result", "error"): return
+        finally:
+            request.cancelled = True
+
+    # the final result of one request (raises on error / deadline)
+    async def detect_result(self, image, response, prompt="", deadline_s=None):
+        async for event in self.detect(image, response, prompt, deadline_s):
+            if event["type"] == "result": return event["result"]
+            if event["type"] == "error":
+                if event["error"] == "deadline exceeded": raise DeadlineExceeded(image)
+                raise RuntimeError(event["error"])
+
+
+# ---------------------------
+# ---------------------------
+        # HTTP front end
+# ---------------------------
+# ---------------------------
+
+# minimal HTTP/1.1 server: POST /detect with a JSON body {"image", "response", "prompt", "deadline_s"}
+# answers with NDJSON (one event per line, flushed as soon as it is ready); a client disconnect cancels the request
+async def _handle_http(service, reader, writer):
+    try:
+        request_line = (await reader.readline()).decode("latin-1").split()
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line: break
+            key, _, value = line.partition(":")
+            headers[key.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+        if request_line[:2] == ["GET", "/health"]:
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nConnection: close\r\n\r\n")
+            writer.write(json.dumps({"status": "ok", "batches": service.num_batches, "dedup": service.dedup_stats}).encode() + b"\n")
+            await writer.drain()
+            return
+        if request_line[:2] != ["POST", "/detect"]:
+            writer.write(b"HTTP/1.1 404 Not Found\r\nConnection: close\r\n\r\n")
+            await writer.drain()
+            return
+        try:
+            payload = json.loads(body)
+            image, response = payload["image"], payload["response"]
+            service.image_path(image)
+        except (ValueError, KeyError, TypeError) as error:
+            writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Type: application/json\r\nConnection: close\r\n\r\n")
+            writer.write(json.dumps({"type": "error", "error": repr(error)}).encode() + b"\n")
+            await writer.drain()
+            return
+
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nConnection: close\r\n\r\n")
+        events = service.detect(image, response, payload.get("prompt", ""), payload.get("deadline_s"))
+        try:
+            async for event in events:
+                writer.write(json.dumps(event).encode() + b"\n")
+                await writer.drain()
+        finally:
+            await events.aclose()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def start_http_server(service, host=SERVE_HOST, port=SERVE_PORT):
+    return await asyncio.start_server(lambda reader, writer: _handle_http(service, reader, writer), host, port)
+
+# HTTP client: async generator of the events of one request
+async def http_detect(image, response, prompt="", deadline_s=None, host=SERVE_HOST, port=SERVE_PORT):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        body = json.dumps({"image": image, "response": response, "prompt": prompt, "deadline_s": deadline_s}).encode()
+        writer.write(f"POST /detect HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+        await writer.drain()
+        status = (await reader.readline()).decode("latin-1").split()
+        while (await reader.readline()).strip():
+            pass # headers
+        if status[1] != "200": raise RuntimeError(f"HTTP {status[1]}: {(await reader.read()).decode()}")
+        async for line in reader:
+            if line.strip(): yield json.loads(line)
+    finally:
+        writer.close()
+
+
+def make_service_backends(backend):
+    if backend == "qwen":
+        from qwen_wrapper import Qwen_2_5_LLM_7B_Instruct, Qwen_2_5_VL_7B_Instruct
+        return Qwen_2_5_LLM_7B_Instruct(), Qwen_2_5_VL_7B_Instruct()
+    from benchmark import make_backends
+    return make_backends(backend)
+
+async def serve(backend="qwen", host=SERVE_HOST, port=SERVE_PORT):
+    qwen_llm, qwen_vlm = make_service_backends(backend)
+    async with HalDetectionService(qwen_llm, qwen_vlm) as service:
+        server = await start_http_server(service, host, port)
+        print(f"Serving on http://{host}:{port} (POST /detect, GET /health)")
+        async with server:
+            await server.serve_forever()
+
+# this function is to send num_requests concurrent requests (POVID entries) through the HTTP front end of a local
+# server on stub / tiny backends, and report the per-request latency and the number of batches of each stage
+async def demo(backend="stub", num_requests=32, data_path=None, deadline_s=None, port=0):
+    from benchmark import BENCHMARK_DATA_PATH
+    with open(data_path or BENCHMARK_DATA_PATH, "r") as f:
+        entries = json.load(f)[:num_requests]
+    qwen_llm, qwen_vlm = make_service_backends(backend)
+    async with HalDetectionService(qwen_llm, qwen_vlm) as service:
+        server = await start_http_server(service, SERVE_HOST, port)
+        port = server.sockets[0].getsockname()[1]
+
+        async def one(entry):
+            start = time.perf_counter()
+            first_verdict, result = None, None
+            async for event in http_detect(entry["image"], entry["initial_response"], entry["prompt"], deadline_s, SERVE_HOST, port):
+                if event["type"] == "verdict" and first_verdict is None: first_verdict = time.perf_counter() - start
+                if event["type"] == "result": result = event["result"]
+            return first_verdict, time.perf_counter() - start, result
+
+        async with server:
+            outputs = await asyncio.gather(*[one(entry) for entry in entries])
+    latencies = sorted(total for _, total, _ in outputs)
+    return {
+        "num_requests": len(entries),
+        "num_completed": sum(result is not None for _, _, result in outputs),
+        "batches": service.num_batches,
+        "p50_ms": round(1000 * latencies[len(latencies) // 2], 2) if latencies else None,
+        "max_ms": round(1000 * latencies[-1], 2) if latencies else None,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    serve_parser = subparsers.add_parser("serve", help="run the HTTP server")
+    serve_parser.add_argument("--backend", choices=["qwen", "stub", "tiny"], default="qwen")
+    serve_parser.add_argument("--host", default=SERVE_HOST)
+    serve_parser.add_argument("--port", type=int, default=SERVE_PORT)
+    demo_parser = subparsers.add_parser("demo", help="concurrent requests against a local server on fake backends")
+    demo_parser.add_argument("--backend", choices=["stub", "tiny"], default="stub")
+    demo_parser.add_argument("--num-requests", type=int, default=32)
+    demo_parser.add_argument("--deadline-s", type=float, default=None)
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        try:
+            asyncio.run(serve(args.backend, args.host, args.port))
+        except KeyboardInterrupt:
+            sys.exit(0)
+    else:
+        print(json.dumps(asyncio.run(demo(args.backend, args.num_requests, deadline_s=args.deadline_s)), indent=4))
@@ -0,0 +1,76 @@
+"""
+per-entry manifest of what each pipeline stage's output depends on, used for incremental re-annotation
+"""
+
+import os
+import json
+
+from result_cache import ResultCache
+
+# in pipeline order: a stage is recomputed when its own dependencies or those of an earlier stage changed
+STAGES = ("extract", "annotate", "rectify")
+
+# this function is to chain the dependencies of each stage into one hash per stage
+# deps: {stage: [model id, prompt template, inputs ...]}, in STAGES order
+def chain_stage_hashes(deps):
+    hashes, previous = {}, ""
+    for stage in STAGES:
+        previous = hashes[stage] = ResultCache.make_key(previous, *deps[stage])
+    return hashes
+
+def manifest_key(key):
+    return json.dumps(list(key))
+
+
+class RunManifest:
+    """
+    {entry key: {stage: hash}} of the results of an output file, stored as <output>_manifest.json.
+    An entry whose hashes all match is unchanged; otherwise the first stale stage (and the ones after it) are rerun.
+    During a run, flush() appends the entries set since the last flush to <output>_manifest.json.log (cheap enough
+    to call every few results); the journal is replayed on load and folded into the JSON file by save().
+    """
+    def __init__(self, path):
+        self.path = path
+        self.journal_path = path + ".log"
+        self.entries = {}
+        self._unflushed = []
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.entries = json.load(f)
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, "r") as f:
+                for line in f:
+                    if not line.endswith("\n"): break # partial line left by a crash
+                    key, hashes = json.loads(line)
+                    self.entries[key] = hashes
+
+    def get(self, key):
+        return self.entries.get(manifest_key(key))
+
+    def set(self, key, hashes):
+        self.entries[manifest_key(key)] = hashes
+        self._unflushed.append(manifest_key(key))
+
+    # first stage whose hash differs from the recorded one (None --> the entry is up to date)
+    def first_stale_stage(self, key, hashes):
+        recorded = self.get(key) or {}
+        for stage in STAGES:
+            if recorded.get(stage) != hashes[stage]: return stage
+        return None
+
+    def flush(self):
+        if not self._unflushed: return
+        with open(self.journal_path, "a") as f:
+            for key in self._unflushed:
+                f.write(json.dumps([key, self.entries[key]]) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._unflushed = []
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
+        if os.path.exists(self.journal_path): os.remove(self.journal_path)
+        self._unflushed = []
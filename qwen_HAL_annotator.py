@@ -1,10 +1,26 @@
+import os
 import json
 import re
+import argparse
 from tqdm import tqdm
 import random
-
-from qwen_wrapper import Qwen_2_5_LLM_7B_Instruct, Qwen_2_5_VL_7B_Instruct
-from utils import IMAGE_DIR, DATA_PATH, SAVE_PATH
+import math
+import time
+import queue
+import threading
+import functools
+from collections import namedtuple
+
+from qwen_wrapper import Qwen_2_5_LLM_7B_Instruct, Qwen_2_5_VL_7B_Instruct, get_claim_extraction_prompt
+from annotation_store import write_annotation_store
+from manifest import STAGES, RunManifest, chain_stage_hashes
+from result_cache import ResultCache, EXTRACTION, ANNOTATION, RECTIFICATION, file_digest
+from tracing import TRACER, traced
+from utils import IMAGE_DIR, DATA_PATH, SAVE_PATH, RESUME, INCREMENTAL, SEQUENTIAL_MODELS, USE_RESULT_CACHE, WRITE_ANNOTATION_STORE, get_output_paths, get_shard
+from utils import ENTRIES_PER_CHUNK, ANNOTATION_BATCH_SIZE
+from utils import USE_PREFIX_CACHE, USE_FAST_VERDICT, FAST_VERDICT_EXPLAIN_FLAGGED, VERDICT_CALIBRATION, VERDICT_CALIBRATION_PATH, VERDICT_CALIBRATION_CLAIMS
+from utils import DEDUP_CLAIMS, RECTIFICATION_BATCH_SIZE, USE_PROMPT_LOOKUP, USE_PIPELINE, PIPELINE_QUEUE_SIZE
+from utils import entry_key, read_jsonl_results, JsonlResultWriter, compact_results
 
 # ---------------------------
 # ---------------------------
@@ -12,7 +28,8 @@ from utils import IMAGE_DIR, DATA_PATH, SAVE_PATH
 # ---------------------------
 # ---------------------------
 
-def get_annotation_prompt(statement):
+# the annotation prompt is a fixed preamble (shared by every claim) followed by a short per-claim suffix
+def get_annotation_prompt_prefix():
     prompt = """You are a visual expert tasked with verifying the accuracy of a statement based on the provided image. Use the visual evidence and your knowledge to evaluate each statement according to the categories below.
 
 ### Evaluation Categories:
@@ -62,11 +79,17 @@ input_image = <an image of two cats sleeping on a pink couch>
 Now, carefully analyze the image and evaluate the following statement.
 
 """
-    prompt += f"[STATEMENT]: {statement}\n"
+    return prompt
+
+def get_annotation_prompt_suffix(statement):
+    prompt = f"[STATEMENT]: {statement}\n"
     prompt += f"[EVALUATION]: \n"
     prompt += f"[REASON]: \n\n"
     return prompt
 
+def get_annotation_prompt(statement):
+    return get_annotation_prompt_prefix() + get_annotation_prompt_suffix(statement)
+
 def get_error_rectification_prompt(initial_description, annotations):
     prompt = f"""You are provided with an initial description of the given image. This description may contain inaccuracies or hallucinations. 
 
@@ -147,105 +170,785 @@ The annotations are as follows:
     return prompt
 
 
+# ---------------------------
+# ---------------------------
+        # Annotation parsing
+# ---------------------------
+# ---------------------------
+
+eval_pattern = r"(?i)evaluation(?:(?!hallucination|non-hallucination).)*?(hallucination|non-hallucination)"
+reason_pattern = r"(?i)reason(.+)"
+
+# this function is to recover the (evaluation, reason) pair from a raw Qwen-VL annotation
+def parse_annotation(response):
+    # Extract evaluation text
+    eval_match = re.search(eval_pattern, response, flags=re.IGNORECASE)
+    evaluation = eval_match.group(1) if eval_match else "Not Found"
+    # Extract reason text
+    reason_match = re.search(reason_pattern, response, flags=re.IGNORECASE | re.DOTALL)
+    # clean up unnecessary characters
+    reason = re.sub(r"^[^:]*:\s*(?:\*\* )?", "", reason_match.group(1)).strip() if reason_match else "Not Found"
+    return evaluation, reason
+
+def format_annotations(statements, evaluations, reasons):
+    final_annotations = ""
+    idx = 1
+    for s,e,r in zip(statements, evaluations, reasons):
+        final_annotations += f"[STATEMENT {idx}]: {s}\n"
+        final_annotations += f"[EVALUATION {idx}]: {e}\n"
+        final_annotations += f"[REASON {idx}]: {r}\n\n"
+        idx += 1
+    return final_annotations
+
+
+# ---------------------------
+# ---------------------------
+        # Fast verdict
+# ---------------------------
+# ---------------------------
+
+# continuations scored after "[EVALUATION]:" (they start with different tokens)
+VERDICT_CANDIDATES = [" hallucination", " non-hallucination"]
+
+# start of the expected annotation output, up to the verdict
+def get_annotation_answer_prefix(statement):
+    return f"[STATEMENT]: {statement}\n[EVALUATION]:"
+
+def _sigmoid(x):
+    if x >= 0: return 1.0 / (1.0 + math.exp(-x))
+    return math.exp(x) / (1.0 + math.exp(x))
+
+# p(hallucination) from the logit margin (hallucination - non-hallucination), with temperature / bias calibration
+def calibrated_hallucination_prob(margin, calibration=VERDICT_CALIBRATION):
+    temperature, bias = calibration
+    return _sigmoid(margin / temperature + bias)
+
+# this function is to fit the (temperature, bias) of calibrated_hallucination_prob with a 1D logistic regression
+# labels are 1 for hallucination and 0 for non-hallucination, e.g. the verdicts of the full (generative) annotation
+def fit_verdict_calibration(margins, labels, lr=0.1, steps=2000):
+    if len(margins) != len(labels) or not margins: raise ValueError("margins and labels must be non-empty and of the same length.")
+    scale, bias = 1.0, 0.0 # p = sigmoid(scale * margin + bias), scale = 1 / temperature
+    n = len(margins)
+    for _ in range(steps):
+        grad_scale, grad_bias = 0.0, 0.0
+        for margin, label in zip(margins, labels):
+            error = _sigmoid(scale * margin + bias) - label
+            grad_scale += error * margin
+            grad_bias += error
+        scale = max(scale - lr * grad_scale / n, 1e-3) # keep the margin's sign meaningful
+        bias -= lr * grad_bias / n
+    return (1.0 / scale, bias)
+
+# the fitted calibration saved by calibrate_fast_verdict, or VERDICT_CALIBRATION if there is none
+def load_verdict_calibration(path=VERDICT_CALIBRATION_PATH):
+    if not os.path.exists(path): return tuple(VERDICT_CALIBRATION)
+    with open(path, "r") as f:
+        fitted = json.load(f)
+    return (fitted["temperature"], fitted["bias"])
+
+# this function is to fit the fast verdict calibration on (a sample of) the claims of save_path that were annotated
+# by the full generative annotation: their verdicts are the labels, the fast verdict logit margins are the inputs
+# the fitted (temperature, bias) are saved to path, with the agreement of the fast verdicts with the labels
+def calibrate_fast_verdict(qwen_vlm=None, save_path=SAVE_PATH, path=VERDICT_CALIBRATION_PATH, num_claims=VERDICT_CALIBRATION_CLAIMS, batch_size=ANNOTATION_BATCH_SIZE, seed=0):
+    labels = {"hallucination": 1, "non-hallucination": 0}
+    with open(save_path, "r") as f:
+        results = json.load(f)
+    # fast verdict annotations carry a hallucination_prob, and can't be their own labels
+    claims = [(IMAGE_DIR + result["image"], claim["claim"], labels[claim["evaluation"].strip().lower()])
+              for result in results for claim in result["evaluated_claims"]
+              if claim.get("hallucination_prob") is None and claim["evaluation"].strip().lower() in labels]
+    if not claims: raise ValueError(f"no generated annotations to calibrate on in {save_path}.")
+    claims = random.Random(seed).sample(claims, min(num_claims, len(claims)))
+
+    if qwen_vlm is None: qwen_vlm = Qwen_2_5_VL_7B_Instruct()
+    margins = []
+    for start in tqdm(range(0, len(claims), batch_size), desc="Verdict calibration"):
+        batch = claims[start:start + batch_size]
+        logits = qwen_vlm.get_candidate_logits(
+            [img_path for img_path, _, _ in batch], [get_annotation_prompt(s) for _, s, _ in batch],
+            [get_annotation_answer_prefix(s) for _, s, _ in batch], VERDICT_CANDIDATES)
+        margins += [hal_logit - non_hal_logit for hal_logit, non_hal_logit in logits]
+    targets = [label for _, _, label in claims]
+    temperature, bias = fit_verdict_calibration(margins, targets)
+    probs = [calibrated_hallucination_prob(margin, (temperature, bias)) for margin in margins]
+    fitted = {
+        "model": qwen_vlm.model_name,
+        "temperature": temperature,
+        "bias": bias,
+        "num_claims": len(claims),
+        "hallucination_rate": round(sum(targets) / len(targets), 4),
+        "agreement": round(sum((prob >= 0.5) == bool(label) for prob, label in zip(probs, targets)) / len(targets), 4),
+        "log_loss": round(-sum(math.log(max(prob if label else 1 - prob, 1e-12)) for prob, label in zip(probs, targets)) / len(targets), 4),
+    }
+    with open(path, "w") as f:
+        json.dump(fitted, f, indent=4)
+    return fitted
+
+
+# ---------------------------
+# ---------------------------
+        # Annotation Scheduler
+# ---------------------------
+# ---------------------------
+
+PendingClaim = namedtuple("PendingClaim", ["entry_id", "claim_idx", "img_path", "statement", "prompt_length"])
+
+class AnnotationScheduler:
+    """
+    Pools the claims of many entries and annotates them with batches of at most batch_size claims.
+    Claims are sorted by prompt length so that each batch carries little padding, and the raw responses
+    are mapped back to each entry in the original claim order.
+    The prefill token budget is left to the VLM (its AdaptiveBatcher splits a batch with the real token counts).
+    The VLM is only used through get_batch_response(img_paths, queries), so any backend exposing it can be plugged in.
+    With use_prefix_cache, claims are grouped per image instead and sent to get_prefix_cached_responses, which
+    encodes the image + annotation preamble once and reuses its KV cache for every claim of that image.
+    With use_fast_verdict, the verdict is read from the logits of a single forward pass (get_candidate_logits)
+    and only the flagged claims are decoded, to get their [REASON] (or none at all if explain_flagged is False).
+    """
+    def __init__(self, qwen_vlm, batch_size=ANNOTATION_BATCH_SIZE, use_prefix_cache=USE_PREFIX_CACHE,
+                 use_fast_verdict=USE_FAST_VERDICT, explain_flagged=FAST_VERDICT_EXPLAIN_FLAGGED, calibration=None):
+        if batch_size < 1: raise ValueError("batch_size must be >= 1.")
+        self.qwen_vlm = qwen_vlm
+        self.batch_size = batch_size
+        self.use_prefix_cache = use_prefix_cache
+        self.use_fast_verdict = use_fast_verdict
+        self.explain_flagged = explain_flagged
+        # see calibrate_fast_verdict
+        self.calibration = tuple(calibration) if calibration is not None else load_verdict_calibration()
+        self.hallucination_probs = {}
+        self.pending = []
+        self.num_claims = {}
+
+    def add(self, entry_id, img_path, statements):
+        if entry_id in self.num_claims: raise ValueError(f"entry {entry_id} was already added.")
+        self.num_claims[entry_id] = len(statements)
+        for claim_idx, s in enumerate(statements):
+            self.pending.append(PendingClaim(entry_id, claim_idx, img_path, s, len(get_annotation_prompt(s))))
+
+    def make_batches(self):
+        batches = []
+        batch = []
+        for item in sorted(self.pending, key=lambda x: x.prompt_length):
+            if len(batch) >= self.batch_size:
+                batches.append(batch)
+                batch = []
+            batch.append(item)
+        if batch: batches.append(batch)
+        return batches
+
+    # one group per image, claims kept in the order they were added
+    def make_image_groups(self):
+        groups = {}
+        for item in self.pending:
+            groups.setdefault(item.img_path, []).append(item)
+        return list(groups.values())
+
+    # what the raw annotations depend on besides the prompt, image and claim (used in result cache keys)
+    def mode_tag(self):
+        if self.use_fast_verdict: return f"fast-verdict|{self.calibration}|explain={self.explain_flagged}"
+        return "generate"
+
+    # returns {entry_id: [raw annotation of each claim, in the original claim order]}
+    # in fast verdict mode, self.hallucination_probs holds the calibrated p(hallucination) of each claim (None otherwise)
+    def run(self):
+        responses = {entry_id: [None] * n for entry_id, n in self.num_claims.items()}
+        self.hallucination_probs = {entry_id: [None] * n for entry_id, n in self.num_claims.items()}
+        if self.use_fast_verdict:
+            for batch in self.make_batches():
+                self._run_fast_verdict(batch, responses)
+        elif self.use_prefix_cache:
+            for group in self.make_image_groups():
+                suffixes = [get_annotation_prompt_suffix(item.statement) for item in group]
+                group_responses = self.qwen_vlm.get_prefix_cached_responses(group[0].img_path, get_annotation_prompt_prefix(), suffixes)
+                for item, response in zip(group, group_responses):
+                    responses[item.entry_id][item.claim_idx] = response
+        else:
+            for batch in self.make_batches():
+                img_paths = [item.img_path for item in batch]
+                queries = [get_annotation_prompt(item.statement) for item in batch]
+                batch_responses = self.qwen_vlm.get_batch_response(img_paths, queries)
+                for item, response in zip(batch, batch_responses):
+                    responses[item.entry_id][item.claim_idx] = response
+        self.pending = []
+        self.num_claims = {}
+        return responses
+
+    # one forward pass scores "hallucination" vs "non-hallucination" right after "[EVALUATION]:",
+    # then (optionally) the [REASON] is generated for the flagged claims only
+    def _run_fast_verdict(self, batch, responses):
+        img_paths = [item.img_path for item in batch]
+        queries = [get_annotation_prompt(item.statement) for item in batch]
+        answer_prefixes = [get_annotation_answer_prefix(item.statement) for item in batch]
+        logits = self.qwen_vlm.get_candidate_logits(img_paths, queries, answer_prefixes, VERDICT_CANDIDATES)
+        flagged = []
+        for k, (item, (hal_logit, non_hal_logit)) in enumerate(zip(batch, logits)):
+            prob = calibrated_hallucination_prob(hal_logit - non_hal_logit, self.calibration)
+            evaluation = "hallucination" if prob >= 0.5 else "non-hallucination"
+            self.hallucination_probs[item.entry_id][item.claim_idx] = prob
+            # same layout as a generated annotation, so that parse_annotation applies
+            responses[item.entry_id][item.claim_idx] = f"{answer_prefixes[k]} {evaluation}\n[REASON]:"
+            if evaluation == "hallucination" and self.explain_flagged: flagged.append(k)
+        if flagged:
+            reason_prefixes = [responses[batch[k].entry_id][batch[k].claim_idx] for k in flagged]
+            reasons = self.qwen_vlm.get_batch_response([img_paths[k] for k in flagged], [queries[k] for k in flagged], reason_prefixes)
+            for k, reason_prefix, reason in zip(flagged, reason_prefixes, reasons):
+                responses[batch[k].entry_id][batch[k].claim_idx] = reason_prefix + reason
+
+
+# case / punctuation / whitespace insensitive form of a claim, e.g. "The cows are on a farm." --> "the cows are on a farm"
+def normalize_claim(statement):
+    return " ".join(re.sub(r"[^\w\s']", " ", statement.casefold()).split())
+
+class ClaimDedupIndex:
+    """
+    Remembers the annotation of every (image, normalized claim) pair sent to the VLM during a run, so that
+    the other occurrences of the pair (same caption facts, same image shared by VQA and captioning entries,
+    in the same chunk or a later one) reuse it instead of being annotated again.
+    Only used from the annotation stage, which runs on a single worker.
+    """
+    def __init__(self):
+        self.annotations = {}
+        self.num_claims = 0 # claims that needed an annotation (i.e. not found in the result cache)
+        self.num_reused = 0 # ... of which were answered by another occurrence of the same pair
+
+    # the scheduler mode is part of the key, since it changes the annotation
+    def make_key(self, img_path, statement, mode_tag):
+        return (img_path, mode_tag, normalize_claim(statement))
+
+    def lookup(self, key):
+        self.num_claims += 1
+        annotation = self.annotations.get(key)
+        if annotation is not None: self.num_reused += 1
+        return annotation
+
+    # a later copy of a pair that is already queued for the VLM in the current chunk
+    def add_duplicate(self):
+        self.num_reused += 1
+
+    def put(self, key, annotation):
+        self.annotations[key] = annotation
+
+    def report(self):
+        return {
+            "claims": self.num_claims,
+            "unique": self.num_claims - self.num_reused,
+            "saved_calls": self.num_reused,
+            "dedup_rate": round(self.num_reused / self.num_claims, 4) if self.num_claims else 0.0,
+        }
+
+
 # ---------------------------
 # ---------------------------
         # Qwen HAL Detector
 # ---------------------------
 # ---------------------------
 
-def main():
-    
-    # Initialize the Qwen models
-    qwen_vlm = Qwen_2_5_VL_7B_Instruct()
-    qwen_llm = Qwen_2_5_LLM_7B_Instruct()
-    print(f"\nModels loaded ...\n")
+def new_work(entry):
+    return {
+        "entry": entry,
+        "img_path": IMAGE_DIR + entry['image'], # load image
+        "initial_response": entry['initial_response'], # initial (potentially hallucinated) response
+        "statements": None,
+        "evaluations": None,
+        "reasons": None,
+        "hallucination_probs": None,
+        "final_annotations": None,
+        "refined_response": None,
+        "rectification_status": None,
+        "stage_hashes": None, # see compute_stage_hashes
+    }
+
+# what each stage's output depends on, as chained hashes (see manifest.py); image_digest(img_path) hashes the image bytes
+def compute_stage_hashes(qwen_llm, qwen_vlm, work, image_digest, mode_tag):
+    return chain_stage_hashes({
+        "extract": [qwen_llm.model_name, get_claim_extraction_prompt(""), work["initial_response"]],
+        "annotate": [qwen_vlm.model_name, get_annotation_prompt(""), mode_tag, image_digest(work["img_path"])],
+        "rectify": [qwen_vlm.model_name, get_error_rectification_prompt("", ""), rectification_mode_tag()],
+    })
+
+# this function is to reuse the outputs of the stages before stale_stage from a previous result of the same entry
+# (the stage functions below skip the works whose output is already there)
+def restore_work(work, result, stale_stage):
+    done = STAGES[:STAGES.index(stale_stage)]
+    claims = result["evaluated_claims"]
+    if "extract" in done:
+        work["statements"] = [claim["claim"] for claim in claims]
+    if "annotate" in done:
+        work["evaluations"] = [claim["evaluation"] for claim in claims]
+        work["reasons"] = [claim["reason"] for claim in claims]
+        work["hallucination_probs"] = [claim.get("hallucination_prob") for claim in claims]
+        work["final_annotations"] = result["qwen_annotations"]
+    return work
+
+# STEP 1: Claim Extraction
+@traced("stage.extract_claims")
+def extract_chunk_claims(qwen_llm, works, cache=None):
+    todo = [] # (work, cache key) of the entries that still need the LLM
+    for work in [work for work in works if work["statements"] is None]:
+        key = None
+        if cache is not None:
+            key = cache.make_key(qwen_llm.model_name, get_claim_extraction_prompt(""), work["initial_response"])
+            work["statements"] = cache.get(EXTRACTION, key)
+        if work["statements"] is None: todo.append((work, key))
+    statements = qwen_llm.extract_claims_batch([work["initial_response"] for work, _ in todo]) if todo else []
+    for (work, key), s in zip(todo, statements):
+        work["statements"] = s
+        if cache is not None: cache.put(EXTRACTION, key, s)
+
+# STEP 2: HAL annotations (each claim MUST be evaluated independently, but claims of many entries share a batch)
+@traced("stage.annotate")
+def annotate_chunk(qwen_vlm, works, scheduler=None, cache=None, dedup=None):
+    scheduler = scheduler or AnnotationScheduler(qwen_vlm)
+    works = [work for work in works if work["evaluations"] is None]
+    # one {"response", "hallucination_prob"} per claim
+    annotations = [[None] * len(work["statements"]) for work in works]
+    claim_keys = [[None] * len(work["statements"]) for work in works]
+    todo = {} # entry_id -> indices of the claims that still need the VLM
+    duplicates = {} # dedup key -> (entry_id, claim idx) of the other copies of a claim queued for the VLM
+    for entry_id, work in enumerate(works):
+        if cache is not None:
+            image_digest = cache.image_digest(work["img_path"])
+            for i, s in enumerate(work["statements"]):
+                claim_keys[entry_id][i] = cache.make_key(qwen_vlm.model_name, get_annotation_prompt(""), scheduler.mode_tag(), image_digest, s)
+                annotations[entry_id][i] = cache.get(ANNOTATION, claim_keys[entry_id][i])
+        todo[entry_id] = []
+        for i, s in enumerate(work["statements"]):
+            if annotations[entry_id][i] is not None: continue
+            if dedup is not None:
+                dedup_key = dedup.make_key(work["img_path"], s, scheduler.mode_tag())
+                annotations[entry_id][i] = dedup.lookup(dedup_key)
+                if annotations[entry_id][i] is not None:
+                    if cache is not None: cache.put(ANNOTATION, claim_keys[entry_id][i], annotations[entry_id][i])
+                    continue
+                if dedup_key in duplicates:
+                    duplicates[dedup_key].append((entry_id, i))
+                    dedup.add_duplicate()
+                    continue
+                duplicates[dedup_key] = []
+            todo[entry_id].append(i)
+        scheduler.add(entry_id, work["img_path"], [work["statements"][i] for i in todo[entry_id]])
+    qwen_batch_annotations = scheduler.run()
+    for entry_id, claim_ids in todo.items():
+        for i, response, prob in zip(claim_ids, qwen_batch_annotations[entry_id], scheduler.hallucination_probs[entry_id]):
+            annotation = {"response": response, "hallucination_prob": prob}
+            copies = [(entry_id, i)]
+            if dedup is not None:
+                dedup_key = dedup.make_key(works[entry_id]["img_path"], works[entry_id]["statements"][i], scheduler.mode_tag())
+                dedup.put(dedup_key, annotation)
+                copies += duplicates[dedup_key]
+            # fan the annotation out to every copy of the claim
+            for e, j in copies:
+                annotations[e][j] = annotation
+                if cache is not None: cache.put(ANNOTATION, claim_keys[e][j], annotation)
+
+    # extract the annotations for each claim and combine them
+    for entry_id, work in enumerate(works):
+        with TRACER.span("annotator.parse_annotations", num_claims=len(annotations[entry_id])):
+            parsed = [parse_annotation(annotation["response"]) for annotation in annotations[entry_id]]
+        work["evaluations"] = [e for e, _ in parsed]
+        work["reasons"] = [r for _, r in parsed]
+        work["hallucination_probs"] = [annotation["hallucination_prob"] for annotation in annotations[entry_id]]
+        work["final_annotations"] = format_annotations(work["statements"], work["evaluations"], work["reasons"])
+
+# STEP 3: get refined response (error-corrected response)
+
+# returns why the initial response can be kept as is, or None if it has to be rectified
+def plan_rectification(work):
+    if not work["statements"]: return "skipped: no claim extracted"
+    if all(e.strip().lower() == "non-hallucination" for e in work["evaluations"]): return "skipped: no claim flagged"
+    return None
+
+# what the refined responses depend on besides the prompt, image and annotations (used in result cache keys):
+# prompt lookup decoding matches greedy decoding only up to floating point differences
+def rectification_mode_tag(use_prompt_lookup=USE_PROMPT_LOOKUP):
+    return "prompt-lookup" if use_prompt_lookup else "generate"
+
+# this function is to rectify several (image, initial response, annotations) triplets with batched generation
+# with use_prompt_lookup, each one is decoded on its own with drafts copied from the initial response instead
+def rectify_batch(qwen_vlm, img_paths, initial_responses, annotations, use_prompt_lookup=USE_PROMPT_LOOKUP):
+    prompts = [get_error_rectification_prompt(r, a) for r, a in zip(initial_responses, annotations)]
+    if use_prompt_lookup: return qwen_vlm.get_prompt_lookup_responses(img_paths, prompts)
+    return qwen_vlm.get_batch_response(img_paths, prompts)
+
+@traced("stage.rectify")
+def rectify_chunk(qwen_vlm, works, cache=None, batch_size=RECTIFICATION_BATCH_SIZE, use_prompt_lookup=USE_PROMPT_LOOKUP):
+    todo = [] # (work, cache key) of the entries that still need the VLM
+    for work in [work for work in works if work["refined_response"] is None]:
+        skip_reason = plan_rectification(work)
+        if skip_reason is not None:
+            work["refined_response"] = work["initial_response"]
+            work["rectification_status"] = skip_reason
+            continue
+        work["rectification_status"] = "rectified"
+        key = None
+        if cache is not None:
+            key = cache.make_key(qwen_vlm.model_name, get_error_rectification_prompt("", ""), rectification_mode_tag(use_prompt_lookup),
+                                 cache.image_digest(work["img_path"]), work["initial_response"], work["final_annotations"])
+            work["refined_response"] = cache.get(RECTIFICATION, key)
+            if work["refined_response"] is not None: continue
+        todo.append((work, key))
+
+    # entries of similar prompt length share a batch
+    todo.sort(key=lambda x: len(x[0]["initial_response"]) + len(x[0]["final_annotations"]))
+    for start in range(0, len(todo), batch_size):
+        batch = todo[start:start + batch_size]
+        refined_responses = rectify_batch(
+            qwen_vlm,
+            [work["img_path"] for work, _ in batch],
+            [work["initial_response"] for work, _ in batch],
+            [work["final_annotations"] for work, _ in batch],
+            use_prompt_lookup=use_prompt_lookup)
+        for (work, key), refined_response in zip(batch, refined_responses):
+            work["refined_response"] = refined_response
+            if cache is not None: cache.put(RECTIFICATION, key, refined_response)
+
+def build_final_result(work):
+    # Append the evaluation and reason to each claim's information
+    evaluated_claims = []
+
+    for i, claim in enumerate(work["statements"]):
+        _claim = {
+            "claim": claim,
+            "evaluation": work["evaluations"][i],
+            "reason": work["reasons"][i]
+        }
+        # calibrated p(hallucination), only available in fast verdict mode
+        if work["hallucination_probs"] and work["hallucination_probs"][i] is not None:
+            _claim["hallucination_prob"] = work["hallucination_probs"][i]
+        evaluated_claims.append(_claim)
+
+    # Compile the final evaluation result
+    final_result = {
+        "image": work["entry"]['image'],
+        "prompt": work["entry"]['prompt'],
+        "initial_response": work["initial_response"], # A
+        "qwen_annotations": work["final_annotations"], # B
+        "evaluated_claims": evaluated_claims, # C
+        "refined_response": work["refined_response"], # D
+        "rectification_status": work["rectification_status"], # rectified, or why D is just a copy of A
+    }
+    # A and D are most important, since they can be used for preference tuning methods like DPO
+    # B and C are just for your reference
+    return final_result
+
+def process_chunk_works(qwen_llm, qwen_vlm, works, cache=None, dedup=None):
+    extract_chunk_claims(qwen_llm, works, cache)
+    annotate_chunk(qwen_vlm, works, cache=cache, dedup=dedup)
+    rectify_chunk(qwen_vlm, works, cache)
+    return works
+
+def process_chunk(qwen_llm, qwen_vlm, chunk, cache=None, dedup=None):
+    works = process_chunk_works(qwen_llm, qwen_vlm, [new_work(entry) for entry in chunk], cache, dedup)
+    return [build_final_result(work) for work in works]
 
-    # Load the JSON file
-    with open(DATA_PATH, "r") as f:
-        val_data = json.load(f)
+# ---------------------------
+# ---------------------------
+        # Pipelined execution
+# ---------------------------
+# ---------------------------
 
-    # List to store all results
-    all_results = []
-
-    # for entry in tqdm(random.sample(val_data,k=10)): # for troubleshooting
-    for entry in tqdm(val_data):
-        
-        # load image
-        img_path = IMAGE_DIR + entry['image']
-        
-        # initial (potentially hallucinated) response
-        initial_response = entry['initial_response']
-
-        # STEP 1: Claim Extraction
-        statements = qwen_llm.extract_claims(initial_response)
-        
-        # STEP 2: HAL annotations (each claim MUST be evaluated independently)
-        image_paths = []
-        statements_to_be_evaluated = []
-        for s in statements:
-            image_paths.append(img_path)
-            statements_to_be_evaluated.append(get_annotation_prompt(s))
-        qwen_batch_annotations = qwen_vlm.get_batch_response(image_paths, statements_to_be_evaluated)
-
-        # extract the annotations for each claim and combine them
-        evaluations = []
-        reasons = []
-        eval_pattern = r"(?i)evaluation(?:(?!hallucination|non-hallucination).)*?(hallucination|non-hallucination)"
-        reason_pattern = r"(?i)reason(.+)"
-
-        for response in qwen_batch_annotations:
-            # Extract evaluation text
-            eval_match = re.search(eval_pattern, response, flags=re.IGNORECASE)
-            evaluation = eval_match.group(1) if eval_match else "Not Found"
-            evaluations.append(evaluation)
-            # Extract reason text
-            reason_match = re.search(reason_pattern, response, flags=re.IGNORECASE | re.DOTALL)
-            # clean up unnecessary characters
-            reason = re.sub(r"^[^:]*:\s*(?:\*\* )?", "", reason_match.group(1)).strip() if reason_match else "Not Found"
-            reasons.append(reason)
-
-        final_annotations = ""
-        idx = 1
-        for s,e,r in zip(statements, evaluations, reasons):
-            final_annotations += f"[STATEMENT {idx}]: {s}\n"
-            final_annotations += f"[EVALUATION {idx}]: {e}\n"
-            final_annotations += f"[REASON {idx}]: {r}\n\n"
-            idx += 1
-
-        # STEP 3: get refined response (error-corrected response)
-        error_rectification_prompt = get_error_rectification_prompt(initial_response, final_annotations)
-        refined_response = qwen_vlm.get_response(img_path, error_rectification_prompt)
-
-        # Append the evaluation and reason to each claim's information
-        evaluated_claims = []
-
-        for i, claim in enumerate(statements):            
-            _claim = {
-                "claim": claim,
-                "evaluation": evaluations[i],
-                "reason": reasons[i]
+# fn(item) -> item; stages sharing a model must share a lock (the wrappers are not thread-safe)
+Stage = namedtuple("Stage", ["name", "fn", "num_workers", "lock"], defaults=[1, None])
+
+_STOP = object()
+# error of the items a stage skipped after another item failed: they never reach the consumer
+_SKIPPED = object()
+# how often a thread blocked on a pipeline queue checks whether the consumer is gone
+_POLL_S = 0.1
+
+class StagePipeline:
+    """
+    Runs items through a sequence of stages connected by bounded queues, each stage having its own worker threads.
+    A full queue blocks the workers feeding it (backpressure), so at most `queue_size` items wait between two stages,
+    and while stage i works on item k, stage i-1 can already work on item k+1.
+    Outputs are yielded in input order. Per-stage busy / starved (waiting for input) / blocked (waiting on a full
+    output queue) / lock_wait (waiting for a shared model) times are kept in `self.stats`.
+    When a stage raises or the consumer stops early, the remaining items are skipped (and never yielded, so only
+    items that went through every stage come out) and every thread exits (blocked threads give up once the consumer
+    is gone) before run() returns.
+    """
+    def __init__(self, stages, queue_size=PIPELINE_QUEUE_SIZE):
+        if not stages: raise ValueError("at least one stage is required.")
+        self.stages = stages
+        self.queue_size = queue_size
+        self.stats = {}
+        self.wall_time = 0.0
+
+    # put / get that give up (return False / _STOP) once the consumer is gone, instead of blocking for good
+    def _put(self, q, item):
+        while not self._closed.is_set():
+            try:
+                q.put(item, timeout=_POLL_S)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q):
+        while not self._closed.is_set():
+            try:
+                return q.get(timeout=_POLL_S)
+            except queue.Empty:
+                pass
+        return _STOP
+
+    def _worker(self, stage, in_q, out_q, remaining):
+        stats = self.stats[stage.name]
+        while True:
+            t0 = time.perf_counter()
+            item = self._get(in_q)
+            t1 = time.perf_counter()
+            if item is _STOP:
+                self._put(in_q, _STOP) # let the other workers of this stage see it too
+                with stats["lock"]:
+                    stats["starved"] += t1 - t0
+                    remaining[stage.name] -= 1
+                    last_worker = remaining[stage.name] == 0
+                if last_worker: self._put(out_q, _STOP)
+                return
+            idx, payload, error = item
+            lock_wait = 0.0
+            if error is None and self._failed.is_set():
+                error = _SKIPPED
+            elif error is None:
+                try:
+                    if stage.lock is not None:
+                        with stage.lock:
+                            lock_wait = time.perf_counter() - t1
+                            payload = stage.fn(payload)
+                    else:
+                        payload = stage.fn(payload)
+                except BaseException as e:
+                    error = e
+                    self._failed.set()
+            t2 = time.perf_counter()
+            if not self._put(out_q, (idx, payload, error)): return
+            t3 = time.perf_counter()
+            with stats["lock"]:
+                stats["starved"] += t1 - t0
+                stats["lock_wait"] += lock_wait
+                stats["busy"] += t2 - t1 - lock_wait
+                stats["blocked"] += t3 - t2
+                stats["items"] += 1
+
+    def _feed(self, items, in_q):
+        for idx, item in enumerate(items):
+            if self._failed.is_set() or not self._put(in_q, (idx, item, None)): break
+        self._put(in_q, _STOP)
+
+    def run(self, items):
+        self._failed = threading.Event() # a stage raised: the remaining items are passed through as _SKIPPED
+        self._closed = threading.Event() # the consumer is gone: the threads stop waiting on the queues
+        self.stats = {stage.name: {"busy": 0.0, "starved": 0.0, "blocked": 0.0, "lock_wait": 0.0, "items": 0, "lock": threading.Lock()} for stage in self.stages}
+        remaining = {stage.name: stage.num_workers for stage in self.stages}
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self._feed, args=(items, queues[0]), daemon=True)]
+        for stage, in_q, out_q in zip(self.stages, queues[:-1], queues[1:]):
+            for _ in range(stage.num_workers):
+                threads.append(threading.Thread(target=self._worker, args=(stage, in_q, out_q, remaining), daemon=True))
+
+        start = time.perf_counter()
+        for thread in threads: thread.start()
+        try:
+            # re-order the outputs, since multi-worker stages may finish items out of order
+            done = {}
+            next_idx = 0
+            while True:
+                item = queues[-1].get()
+                if item is _STOP: break
+                idx, payload, error = item
+                if error is _SKIPPED: continue # a stage failed, its error is on the way
+                if error is not None: raise error
+                done[idx] = payload
+                while next_idx in done:
+                    yield done.pop(next_idx)
+                    next_idx += 1
+        finally:
+            self._failed.set()
+            self._closed.set()
+            # a worker inside stage.fn finishes its current item first
+            for thread in threads: thread.join()
+            self.wall_time = time.perf_counter() - start
+
+    # occupancy = fraction of the wall time the stage's workers spent doing work (the bottleneck is close to 1)
+    def report(self):
+        report = {}
+        for stage in self.stages:
+            stats = self.stats.get(stage.name)
+            if stats is None: continue
+            capacity = max(self.wall_time * stage.num_workers, 1e-9)
+            report[stage.name] = {
+                "items": stats["items"],
+                "busy_s": round(stats["busy"], 3),
+                "starved_s": round(stats["starved"], 3),
+                "blocked_s": round(stats["blocked"], 3),
+                "lock_wait_s": round(stats["lock_wait"], 3),
+                "occupancy": round(stats["busy"] / capacity, 3),
             }
-            evaluated_claims.append(_claim)
-        
-        # Compile the final evaluation result
-        final_result = {
-            "image": entry['image'],
-            "prompt": entry['prompt'],
-            "initial_response": initial_response, # A
-            "qwen_annotations": final_annotations, # B
-            "evaluated_claims": evaluated_claims, # C
-            "refined_response": refined_response, # D
-        }
-        # A and D are most important, since they can be used for preference tuning methods like DPO
-        # B and C are just for your reference
+        return report
+
+# decode / preprocess the chunk's images in the background when the VLM supports it, otherwise
+# do a best-effort read of the image files, so that they are in the OS page cache when the VLM needs them
+@traced("stage.prefetch_images")
+def prefetch_chunk_images(works, qwen_vlm=None):
+    img_paths = list(dict.fromkeys(work["img_path"] for work in works if work["evaluations"] is None))
+    if hasattr(qwen_vlm, "prefetch_images"):
+        qwen_vlm.prefetch_images(img_paths)
+        return
+    for img_path in img_paths:
+        try:
+            with open(img_path, "rb") as f:
+                f.read()
+        except OSError:
+            pass # a missing image is reported by the VLM stage
+
+def make_pipeline(qwen_llm, qwen_vlm, cache=None, dedup=None):
+    def prefetch(works):
+        prefetch_chunk_images(works, qwen_vlm)
+        return works
+    def extract(works):
+        extract_chunk_claims(qwen_llm, works, cache)
+        return works
+    def annotate(works):
+        annotate_chunk(qwen_vlm, works, cache=cache, dedup=dedup)
+        return works
+    def rectify(works):
+        rectify_chunk(qwen_vlm, works, cache)
+        return works
+    # annotation and rectification both run on the VLM --> they take turns on it
+    vlm_lock = threading.Lock()
+    return StagePipeline([
+        Stage("prefetch", prefetch),
+        Stage("extract", extract),
+        Stage("annotate", annotate, lock=vlm_lock),
+        Stage("rectify", rectify, lock=vlm_lock),
+    ])
+
+# qwen_llm / qwen_vlm default to the Qwen 2.5 7B models, but any backend with the same interface can be plugged in (see benchmark.py)
+# shard=(shard_id, num_shards) only processes that shard of the dataset (see sharded_runner.py)
+# with sequential_models, the LLM is unloaded after claim extraction so that it is never resident together with the VLM
+# with incremental, only the entries (and stages) whose inputs, prompt templates or models changed since the manifest
+# of the existing output are recomputed, the other results are kept as they are (see manifest.py)
+# returns a small summary of the run (entries / claims processed, wall time)
+def main(qwen_llm=None, qwen_vlm=None, data_path=DATA_PATH, save_path=SAVE_PATH, resume=RESUME, use_pipeline=USE_PIPELINE, use_cache=USE_RESULT_CACHE, limit=None, shard=None, incremental=INCREMENTAL, sequential_models=SEQUENTIAL_MODELS):
+    
+    # Initialize the Qwen models (their weights are only loaded once a stage actually needs them)
+    if qwen_vlm is None: qwen_vlm = Qwen_2_5_VL_7B_Instruct()
+    if qwen_llm is None: qwen_llm = Qwen_2_5_LLM_7B_Instruct()
 
-        # Add the final result to the list
-        all_results.append(final_result)
+    # Load the JSON file
+    with open(data_path, "r") as f:
+        val_data = json.load(f)
+    if limit is not None: val_data = val_data[:limit]
+    if shard is not None: val_data = get_shard(val_data, *shard)
+    output_paths = get_output_paths(save_path)
+
+    # val_data = random.sample(val_data,k=10) # for troubleshooting
+    manifest = RunManifest(output_paths["manifest"])
+    cache = ResultCache() if use_cache else None
+    # each image is hashed once per run, shared by the manifest and the result cache keys
+    image_digest = cache.image_digest if cache is not None else functools.lru_cache(maxsize=None)(file_digest)
+    mode_tag = AnnotationScheduler(qwen_vlm).mode_tag()
+    todo = [new_work(entry) for entry in val_data]
+    if resume or incremental:
+        # diff the entries already streamed by a previous run against its manifest: an entry is only skipped
+        # if the hashes of all its stages match (e.g. a prompt edit since then invalidates its results)
+        previous = {entry_key(result): result for result in read_jsonl_results(output_paths["stream"])}
+        if incremental and not previous and os.path.exists(save_path):
+            # only the compacted output is left --> it becomes the stream the new results are appended to
+            with open(save_path, "r") as f:
+                results = json.load(f)
+            with JsonlResultWriter(output_paths["stream"], resume=False) as writer:
+                for result in results:
+                    writer.write(result)
+            previous = {entry_key(result): result for result in results}
+        if previous:
+            todo, num_stale = [], {stage: 0 for stage in STAGES}
+            for work in [new_work(entry) for entry in val_data]:
+                key = entry_key(work["entry"])
+                if key not in previous:
+                    todo.append(work)
+                    continue
+                # only the entries with a previous result are hashed here, the others once they are done
+                work["stage_hashes"] = compute_stage_hashes(qwen_llm, qwen_vlm, work, image_digest, mode_tag)
+                stale_stage = manifest.first_stale_stage(key, work["stage_hashes"])
+                if stale_stage is None: continue
+                num_stale[stale_stage] += 1
+                # incremental runs also keep the outputs of the stages before the stale one
+                todo.append(restore_work(work, previous[key], stale_stage) if incremental else new_work(work["entry"]))
+            print(f"\n{'Incremental' if incremental else 'Resuming'}: {len(val_data) - len(todo)} entries up to date, recomputing from {num_stale}\n")
+
+    # entries are processed in chunks so that the claims of many entries can be annotated together
+    # each result is streamed to the .jsonl next to save_path as soon as its chunk is done
+    # with use_pipeline, claim extraction / annotation / rectification of consecutive chunks overlap
+    chunks = [todo[start:start + ENTRIES_PER_CHUNK] for start in range(0, len(todo), ENTRIES_PER_CHUNK)]
+    dedup = ClaimDedupIndex() if DEDUP_CLAIMS else None
+    TRACER.reset()
+    start = time.perf_counter()
+    num_claims = 0
+    if sequential_models:
+        # all the claims first (the annotation stages then skip extraction), then the LLM makes room for the VLM
+        for chunk in tqdm(chunks, desc="Claim extraction"):
+            extract_chunk_claims(qwen_llm, chunk, cache)
+        if hasattr(qwen_llm, "unload"): qwen_llm.unload()
+    pipeline = make_pipeline(qwen_llm, qwen_vlm, cache, dedup) if use_pipeline else None
+    # the manifest is journaled whenever the streamed results are synced, so that a crashed run keeps the hashes of its results
+    with JsonlResultWriter(output_paths["stream"], resume=resume or incremental, on_sync=manifest.flush) as writer, tqdm(total=len(todo)) as pbar:
+        if pipeline is not None:
+            done_chunks = pipeline.run(chunks)
+        else:
+            done_chunks = (process_chunk_works(qwen_llm, qwen_vlm, chunk, cache, dedup) for chunk in chunks)
+        for works in done_chunks:
+            for work in works:
+                if work["stage_hashes"] is None: work["stage_hashes"] = compute_stage_hashes(qwen_llm, qwen_vlm, work, image_digest, mode_tag)
+                manifest.set(entry_key(work["entry"]), work["stage_hashes"])
+                writer.write(build_final_result(work))
+                num_claims += len(work["statements"])
+            pbar.update(len(works))
+    manifest.save()
+    summary = {"num_entries": len(todo), "num_claims": num_claims, "wall_s": round(time.perf_counter() - start, 3)}
+    # models that were never needed (fully resumed / cached run) were never loaded
+    loaded = [getattr(model, "model_name", type(model).__name__) for model in (qwen_llm, qwen_vlm) if getattr(model, "num_loads", 1) > 0]
+    print(f"\nModels loaded: {', '.join(loaded) or 'none'}")
+
+    if pipeline is not None:
+        print("\nPipeline stage occupancy:")
+        for name, stats in pipeline.report().items():
+            print(f"  {name}: {stats}")
+    if cache is not None:
+        print("\nResult cache:")
+        for namespace, stats in cache.report().items():
+            print(f"  {namespace}: {stats}")
+    if dedup is not None:
+        print(f"\nClaim dedup: {dedup.report()}")
+
+    # per-run tracing report (latency / tokens / memory per span) + Chrome trace
+    if TRACER.enabled:
+        TRACER.write_report(output_paths["report"], extra={
+            **summary,
+            "pipeline": pipeline.report() if pipeline is not None else None,
+            "result_cache": cache.report() if cache is not None else None,
+            "claim_dedup": dedup.report() if dedup is not None else None,
+            "load_profiles": {model.model_name: model.load_profile for model in (qwen_llm, qwen_vlm) if hasattr(model, "load_profile")},
+        })
+        TRACER.write_chrome_trace(output_paths["trace"])
+        print(f"\nRun report: {output_paths['report']}, trace: {output_paths['trace']}")
 
     # Save all results to a single JSON file
-    with open(SAVE_PATH, "w") as outfile:
-        json.dump(all_results, outfile, indent=4)
-    print(f"\nSaved to {SAVE_PATH}\n")
+    results = compact_results(output_paths["stream"], save_path, val_data)
+    print(f"\nSaved to {save_path}\n")
+    if WRITE_ANNOTATION_STORE:
+        write_annotation_store(results, output_paths["store"])
+        print(f"Annotation store: {output_paths['store']}\n")
+    return summary
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calibrate", action="store_true", help="fit the fast verdict calibration on the generated annotations of SAVE_PATH, then exit")
+    parser.add_argument("--calibration-claims", type=int, default=VERDICT_CALIBRATION_CLAIMS)
+    args = parser.parse_args()
+    if args.calibrate:
+        fitted = calibrate_fast_verdict(num_claims=args.calibration_claims)
+        print(f"Fast verdict calibration: {fitted}\nSaved to {VERDICT_CALIBRATION_PATH}")
+    else:
+        main()
@@ -1,12 +1,86 @@
 import os
-os.environ["CUDA_VISIBLE_DEVICES"] = "1"
-
-from transformers import AutoModelForCausalLM, AutoTokenizer, Qwen2_5_VLForConditionalGeneration, AutoProcessor
-from qwen_vl_utils import process_vision_info
+# default device, unless the launcher (e.g. sharded_runner.py) already picked one for this process
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "1")
 
+import gc
 import re
-import torch
-from utils import CACHE_DIR
+import copy
+import time
+import functools
+import importlib
+import importlib.util
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from utils import CACHE_DIR, LOAD_PROFILE, OFFLOAD_DIR, OFFLOAD_GPU_MEMORY, OFFLOAD_CPU_MEMORY, EXTRACTION_BATCH_SIZE, VISION_CACHE_MAX_BYTES, VISION_PREFETCH_WORKERS
+from utils import USE_PROMPT_LOOKUP, PROMPT_LOOKUP_NUM_TOKENS, PROMPT_LOOKUP_MAX_NGRAM, VLM_MAX_BATCH_TOKENS
+from tracing import TRACER, traced
+
+
+# torch / transformers / qwen_vl_utils take seconds to import --> they are only imported on first attribute access,
+# so that the prompt / parsing helpers (and tools that only read results) can import this module for free
+class _LazyModule:
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self._name), attr)
+
+torch = _LazyModule("torch")
+transformers = _LazyModule("transformers")
+qwen_vl_utils = _LazyModule("qwen_vl_utils")
+
+# this function is torch.no_grad() as a decorator, without importing torch when the decorated function is defined
+def no_grad(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with torch.no_grad():
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+# how the weights are loaded (see model_load_kwargs):
+# bf16         bfloat16 weights on the GPU(s)
+# int8 / int4  bitsandbytes 8-bit / 4-bit (nf4) weight quantization, bfloat16 compute (GPU only)
+# cpu-offload  bfloat16, at most OFFLOAD_GPU_MEMORY per GPU, the remaining layers in CPU RAM (then on disk)
+# cpu          float32 on CPU only (validation boxes: bf16 matmuls are slow or missing on most CPUs)
+LOAD_PROFILES = ("bf16", "int8", "int4", "cpu-offload", "cpu")
+
+# flash attention 2 needs the flash_attn package and a GPU, sdpa (PyTorch's fused attention) works everywhere
+def attention_implementation(device="cuda"):
+    if device == "cuda" and torch.cuda.is_available() and importlib.util.find_spec("flash_attn") is not None: return "flash_attention_2"
+    return "sdpa"
+
+# this function is to get the from_pretrained kwargs of a load profile
+def model_load_kwargs(load_profile):
+    if load_profile not in LOAD_PROFILES: raise ValueError(f"unknown load profile {load_profile}, expected one of {LOAD_PROFILES}.")
+    if load_profile == "cpu":
+        return {"torch_dtype": torch.float32, "device_map": "cpu", "attn_implementation": attention_implementation("cpu")}
+    if not torch.cuda.is_available(): raise ValueError(f"the {load_profile} load profile needs a GPU, use the cpu profile instead.")
+    kwargs = {"torch_dtype": torch.bfloat16, "device_map": "auto", "attn_implementation": attention_implementation()}
+    if load_profile == "int8":
+        kwargs["quantization_config"] = transformers.BitsAndBytesConfig(load_in_8bit=True)
+    elif load_profile == "int4":
+        kwargs["quantization_config"] = transformers.BitsAndBytesConfig(
+            load_in_4bit=True, bnb_4bit_quant_type="nf4", bnb_4bit_compute_dtype=torch.bfloat16)
+    elif load_profile == "cpu-offload":
+        kwargs["max_memory"] = {**{i: OFFLOAD_GPU_MEMORY for i in range(torch.cuda.device_count())}, "cpu": OFFLOAD_CPU_MEMORY}
+        kwargs["offload_folder"] = OFFLOAD_DIR
+    return kwargs
+
+# this function is from_pretrained with a load profile, inside a tracing span that records the load time and memory
+def load_pretrained(model_class, model_name, load_profile, span_name):
+    with TRACER.span(span_name, load_profile=load_profile) as span:
+        kwargs = model_load_kwargs(load_profile)
+        model = model_class.from_pretrained(model_name, cache_dir=CACHE_DIR, **kwargs)
+        model.eval()
+        span.update(attn_implementation=kwargs["attn_implementation"], footprint_mb=round(model.get_memory_footprint() / 1024 ** 2, 1))
+    return model
+
+# this function is to give the memory of the models no longer referenced back (incl. the cached CUDA blocks)
+def free_memory():
+    gc.collect()
+    if torch.cuda.is_available(): torch.cuda.empty_cache()
 
 def get_claim_extraction_prompt(content):
     prompt = """
@@ -92,21 +166,103 @@ Please breakdown the following into independent facts:
     return prompt + f"{content}\n"
 
 
+# the model is done with the fact list once it starts echoing a new few-shot block
+CLAIM_EXTRACTION_STOP_STRINGS = ["Please breakdown", "[EXAMPLE"]
+
+def parse_claims(response):
+    # Extract claims
+    # Updated regex pattern to capture the contents of each fact
+    _pattern = r"- \[FACT-\d+\] (.+)"
+    _matches = re.findall(_pattern, response)
+    fact_list = [match.strip() for match in _matches]
+    return fact_list
+
+
+# called once per decoding step --> its first call marks the end of the prefill
+# (a plain callable is enough for LogitsProcessorList, so transformers is not needed to define it)
+class _FirstStepTimer:
+    def __init__(self):
+        self.first_step = None
+
+    def __call__(self, input_ids, scores):
+        if self.first_step is None: self.first_step = time.perf_counter()
+        return scores
+
+# this function is model.generate inside a tracing span that records the prefill / decode split,
+# the batch size, the (non-padding) input / output / image tokens and the padding ratio of the batch
+def traced_generate(model, inputs, span_name, **generate_kwargs):
+    if not TRACER.enabled: return model.generate(**inputs, **generate_kwargs)
+    input_ids = inputs["input_ids"]
+    attention_mask = inputs.get("attention_mask")
+    with TRACER.span(span_name) as span:
+        timer = _FirstStepTimer()
+        logits_processor = transformers.LogitsProcessorList([timer] + list(generate_kwargs.pop("logits_processor", None) or []))
+        start = time.perf_counter()
+        generated_ids = model.generate(**inputs, logits_processor=logits_processor, **generate_kwargs)
+        end = time.perf_counter()
+
+        batch_size, input_len = input_ids.shape
+        num_input_tokens = int(attention_mask.sum()) if attention_mask is not None else batch_size * input_len
+        new_ids = generated_ids[:, input_len:]
+        pad_token_id = model.generation_config.pad_token_id
+        num_output_tokens = int((new_ids != pad_token_id).sum()) if pad_token_id is not None else new_ids.numel()
+        image_token_id = getattr(model.config, "image_token_id", None)
+        first_step = timer.first_step or end
+        span.update(
+            batch_size=batch_size,
+            input_tokens=num_input_tokens,
+            image_tokens=int((input_ids == image_token_id).sum()) if image_token_id is not None else 0,
+            output_tokens=num_output_tokens,
+            padding_ratio=round(1 - num_input_tokens / max(batch_size * input_len, 1), 4),
+            prefill_s=round(first_step - start, 6),
+            decode_s=round(end - first_step, 6),
+        )
+    return generated_ids
+
+
 class Qwen_2_5_LLM_7B_Instruct:
-    def __init__(self, ):
+    def __init__(self, use_prompt_lookup=USE_PROMPT_LOOKUP, load_profile=LOAD_PROFILE):
         
-        model_name="Qwen/Qwen2.5-7B-Instruct"
-        self.model = AutoModelForCausalLM.from_pretrained(
-            model_name, 
-            torch_dtype=torch.bfloat16, 
-            device_map="auto",
-            cache_dir=CACHE_DIR,
-            attn_implementation="flash_attention_2")
-        self.model.eval()
-        self.tokenizer = AutoTokenizer.from_pretrained(model_name, cache_dir=CACHE_DIR)
+        self.model_name = "Qwen/Qwen2.5-7B-Instruct"
+        self.load_profile = load_profile
+        # greedy prompt lookup decoding (generate_with_prompt_lookup) instead of model.generate
+        self.use_prompt_lookup = use_prompt_lookup
+        # the weights are only loaded on first use (see the model property), e.g. a resumed run whose
+        # claims are all cached never loads the LLM
+        self._model = None
+        self._tokenizer = None
+        self._load_lock = threading.Lock()
+        self.num_loads = 0
+
+    @property
+    def is_loaded(self):
+        return self._model is not None
+
+    @property
+    def tokenizer(self):
+        with self._load_lock:
+            if self._tokenizer is None:
+                self._tokenizer = transformers.AutoTokenizer.from_pretrained(self.model_name, cache_dir=CACHE_DIR)
+                self._tokenizer.padding_side = "left"
+        return self._tokenizer
+
+    @property
+    def model(self):
+        with self._load_lock:
+            if self._model is None:
+                self._model = load_pretrained(transformers.AutoModelForCausalLM, self.model_name, self.load_profile, "llm.load_model")
+                self.num_loads += 1
+        return self._model
+
+    # frees the weights (e.g. before the VLM stages, see SEQUENTIAL_MODELS); they are loaded again on next use
+    def unload(self):
+        with self._load_lock:
+            was_loaded, self._model = self._model is not None, None
+        if was_loaded: free_memory()
 
     # this function is to get generic text response from qwen
-    @torch.no_grad()
+    @traced("llm.get_response")
+    @no_grad
     def get_response(self, query):
         messages = [
             {"role": "system", "content": "You are Qwen, created by Alibaba Cloud. You are a helpful assistant."},
@@ -115,32 +271,66 @@ class Qwen_2_5_LLM_7B_Instruct:
         text = self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
         model_inputs = self.tokenizer([text], return_tensors="pt")
         model_inputs = model_inputs.to(self.model.device)
+        if self.use_prompt_lookup:
+            # greedy, unlike the default (sampling) generation config used below
+            generated_ids, _ = generate_with_prompt_lookup(self.model, model_inputs, max_new_tokens=2048)
+            return self.tokenizer.decode(generated_ids, skip_special_tokens=True)
         # Generate the text response
-        generated_ids = self.model.generate(**model_inputs, max_new_tokens=2048)
+        generated_ids = traced_generate(self.model, model_inputs, "llm.generate", max_new_tokens=2048)
         generated_ids = [output_ids[len(input_ids):] for input_ids, output_ids in zip(model_inputs.input_ids, generated_ids)]
         response = self.tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]
         return response
     
     # this function is to extract a 'list of claims' from a given text --> developed for HAL detection
-    @torch.no_grad()
     def extract_claims(self, content):
-        messages = [
-            {"role": "system", "content": "You are Qwen, created by Alibaba Cloud. You are a helpful assistant."},
-            {"role": "user", "content": get_claim_extraction_prompt(content)}
-        ]
-        text = self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-        model_inputs = self.tokenizer([text], return_tensors="pt")
-        model_inputs = model_inputs.to(self.model.device)
-        # Generate the text response
-        generated_ids = self.model.generate(**model_inputs, max_new_tokens=2048)
-        generated_ids = [output_ids[len(input_ids):] for input_ids, output_ids in zip(model_inputs.input_ids, generated_ids)]
-        response = self.tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]
-        # Extract claims
-        # Updated regex pattern to capture the contents of each fact
-        _pattern = r"- \[FACT-\d+\] (.+)"
-        _matches = re.findall(_pattern, response)
-        fact_list = [match.strip() for match in _matches]
-        return fact_list
+        return self.extract_claims_batch([content])[0]
+
+    # batched version of extract_claims --> returns one fact list per content, in the input order
+    # prompts are sorted by length and bucketed (left padded), each sequence stops on its own (EOS or a new few-shot block)
+    # decoding is greedy, so a content gets the same fact list whether it is extracted alone or within a batch
+    # (exactly in float32, see benchmark.py batched-extraction; in bf16 the left padding changes the low bits of the
+    # logits, so a near-tie between two tokens can resolve differently)
+    @traced("llm.extract_claims_batch")
+    @no_grad
+    def extract_claims_batch(self, contents, batch_size=EXTRACTION_BATCH_SIZE):
+        if not contents: return []
+        texts = []
+        for content in contents:
+            messages = [
+                {"role": "system", "content": "You are Qwen, created by Alibaba Cloud. You are a helpful assistant."},
+                {"role": "user", "content": get_claim_extraction_prompt(content)}
+            ]
+            texts.append(self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True))
+
+        responses = [None] * len(texts)
+        if self.use_prompt_lookup:
+            # one caption at a time, the facts are mostly drafted from the caption itself
+            stop_fn = make_stop_strings_fn(self.tokenizer, CLAIM_EXTRACTION_STOP_STRINGS)
+            for i, text in enumerate(texts):
+                model_inputs = self.tokenizer([text], return_tensors="pt").to(self.model.device)
+                generated_ids, _ = generate_with_prompt_lookup(self.model, model_inputs, max_new_tokens=2048, stop_fn=stop_fn)
+                responses[i] = self.tokenizer.decode(generated_ids, skip_special_tokens=True)
+            with TRACER.span("llm.parse_claims", num_responses=len(responses)):
+                return [parse_claims(response) for response in responses]
+
+        lengths = [len(ids) for ids in self.tokenizer(texts).input_ids]
+        order = sorted(range(len(texts)), key=lambda i: lengths[i])
+        for start in range(0, len(order), batch_size):
+            bucket = order[start:start + batch_size]
+            model_inputs = self.tokenizer([texts[i] for i in bucket], return_tensors="pt", padding=True)
+            model_inputs = model_inputs.to(self.model.device)
+            # Generate the text response
+            generated_ids = traced_generate(
+                self.model, model_inputs, "llm.generate",
+                max_new_tokens=2048,
+                do_sample=False, temperature=None, top_p=None, top_k=None,
+                stop_strings=CLAIM_EXTRACTION_STOP_STRINGS,
+                tokenizer=self.tokenizer)
+            generated_ids = [output_ids[len(input_ids):] for input_ids, output_ids in zip(model_inputs.input_ids, generated_ids)]
+            for i, response in zip(bucket, self.tokenizer.batch_decode(generated_ids, skip_special_tokens=True)):
+                responses[i] = response
+        with TRACER.span("llm.parse_claims", num_responses=len(responses)):
+            return [parse_claims(response) for response in responses]
 
 
 """
@@ -148,21 +338,390 @@ class Qwen_2_5_LLM_7B_Instruct:
 ==========================================================================================================================================================================
 """
 
+# marks where the shared part of a prompt ends, so that the chat template can be split into prefix / tail
+PREFIX_SPLIT_MARKER = "<<<PREFIX_SPLIT>>>"
+
+# this function is to generate a response for each suffix of a shared prefix, while encoding the prefix only once
+# the KV cache of the prefix is computed with a single forward pass and then forked (deep-copied) for every suffix,
+# so each output is the one that model.generate would give for the full (prefix + suffix) sequence
+# works for any HF causal LM; multimodal inputs (pixel_values, image_grid_thw, ...) are only needed for the prefix
+@no_grad
+def generate_with_prefix_cache(model, prefix_inputs, suffix_ids_list, **generate_kwargs):
+    prefix_ids = prefix_inputs["input_ids"]
+    if prefix_ids.shape[0] != 1: raise ValueError("the prefix must be a single sequence.")
+    # explicit cache_position --> Qwen-VL recomputes its (3D) rope positions for this prefix instead of reusing stale ones
+    cache_position = torch.arange(prefix_ids.shape[1], device=prefix_ids.device)
+    with TRACER.span("prefix_cache.prefill", input_tokens=prefix_ids.shape[1]):
+        prefix_cache = model(**prefix_inputs, cache_position=cache_position, use_cache=True).past_key_values
+
+    outputs = []
+    for suffix_ids in suffix_ids_list:
+        if len(suffix_ids) == 0: raise ValueError("each suffix must contain at least one token.")
+        suffix_ids = torch.as_tensor(suffix_ids, dtype=prefix_ids.dtype, device=prefix_ids.device).view(1, -1)
+        input_ids = torch.cat([prefix_ids, suffix_ids], dim=1)
+        suffix_inputs = {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids), "past_key_values": copy.deepcopy(prefix_cache)}
+        generated_ids = traced_generate(model, suffix_inputs, "prefix_cache.generate", **generate_kwargs)
+        outputs.append(generated_ids[0, input_ids.shape[1]:])
+    return outputs
+
+
+# first token of each candidate continuation, checking that they can be told apart from it
+def first_token_ids(tokenizer, candidates):
+    token_ids = [tokenizer(candidate, add_special_tokens=False).input_ids[0] for candidate in candidates]
+    if len(set(token_ids)) != len(token_ids): raise ValueError(f"candidates {candidates} do not start with different tokens.")
+    return token_ids
+
+# this function is to score candidate continuations of (left padded) sequences with one forward pass
+# returns the logits of each candidate's first token at the last position, shape (batch, n_candidates)
+# works for any HF causal LM; only the last position goes through the LM head
+@no_grad
+def score_first_tokens(model, inputs, candidate_token_ids):
+    # explicit cache_position --> Qwen-VL recomputes its (3D) rope positions for these inputs
+    cache_position = torch.arange(inputs["input_ids"].shape[1], device=inputs["input_ids"].device)
+    with TRACER.span("score_first_tokens", batch_size=inputs["input_ids"].shape[0], input_tokens=int(inputs["attention_mask"].sum())):
+        logits = model(**inputs, cache_position=cache_position, use_cache=False, logits_to_keep=1).logits[:, -1, :]
+    return logits[:, candidate_token_ids].float()
+
+
+# n-gram index of a token sequence, used to draft the next tokens by prompt lookup: the draft is what followed
+# the latest earlier occurrence of the sequence's last n tokens (longest n first)
+class _NgramIndex:
+    def __init__(self, max_ngram):
+        self.max_ngram = max_ngram
+        self.tokens = []
+        self._ends = [{} for _ in range(max_ngram + 1)] # n -> {n-gram: end position of its latest occurrence}
+
+    def extend(self, token_ids):
+        for token_id in token_ids:
+            # the n-grams ending at the current end become "earlier occurrences" once a token follows them
+            end = len(self.tokens)
+            for n in range(1, min(self.max_ngram, end) + 1):
+                self._ends[n][tuple(self.tokens[end - n:end])] = end
+            self.tokens.append(token_id)
+
+    def draft(self, num_tokens):
+        for n in range(min(self.max_ngram, len(self.tokens)), 0, -1):
+            end = self._ends[n].get(tuple(self.tokens[-n:]))
+            if end is not None: return self.tokens[end:end + num_tokens]
+        return []
+
+# greedy choice on one row of logits, after the repetition penalty (as in transformers' RepetitionPenaltyLogitsProcessor)
+def _greedy_token(logits, seen_token_ids, repetition_penalty):
+    logits = logits.float()
+    if repetition_penalty != 1.0 and seen_token_ids:
+        ids = torch.tensor(list(seen_token_ids), device=logits.device)
+        score = logits[ids]
+        logits = logits.clone()
+        logits[ids] = torch.where(score < 0, score * repetition_penalty, score / repetition_penalty)
+    return int(logits.argmax())
+
+# stop_fn for generate_with_prompt_lookup: stop once the generated text contains one of the stop strings
+def make_stop_strings_fn(tokenizer, stop_strings, tail_tokens=16):
+    def stop_fn(token_ids):
+        text = tokenizer.decode(token_ids[-tail_tokens:])
+        return any(stop_string in text for stop_string in stop_strings)
+    return stop_fn
+
+# this function is greedy decoding of a single sequence with prompt lookup speculative decoding:
+# the next tokens are drafted from the prompt / output so far (see _NgramIndex), then the last token and the whole
+# draft go through ONE forward pass, the longest draft prefix matching the greedy choices is accepted, plus the greedy
+# token after it, and the KV cache is cropped back to the accepted tokens.
+# The tokens are the ones of greedy model.generate (same repetition penalty, eos and max_new_tokens), up to floating
+# point differences between one-token and multi-token forward passes; copied spans (rectified responses mostly copy
+# the initial response, claims copy spans of the caption) are decoded several tokens per forward pass.
+# works for any HF causal LM whose cache can be cropped (DynamicCache); multimodal inputs only go into the prefill
+# returns (generated token ids, {drafted, accepted, forwards, ...})
+@no_grad
+def generate_with_prompt_lookup(model, inputs, max_new_tokens, num_draft_tokens=PROMPT_LOOKUP_NUM_TOKENS, max_ngram=PROMPT_LOOKUP_MAX_NGRAM,
+                                 eos_token_ids=None, repetition_penalty=None, stop_fn=None):
+    input_ids = inputs["input_ids"]
+    if input_ids.shape[0] != 1: raise ValueError("prompt lookup decoding runs one sequence at a time.")
+    generation_config = model.generation_config
+    if eos_token_ids is None: eos_token_ids = generation_config.eos_token_id
+    if eos_token_ids is None: eos_token_ids = []
+    eos_token_ids = set(eos_token_ids) if isinstance(eos_token_ids, (list, tuple, set)) else {eos_token_ids}
+    if repetition_penalty is None: repetition_penalty = generation_config.repetition_penalty or 1.0
+
+    index = _NgramIndex(max_ngram)
+    index.extend(input_ids[0].tolist())
+    seen = set(index.tokens)
+    generated = []
+    num_drafted, num_accepted, num_forwards = 0, 0, 1
+
+    # the token just chosen ends the generation
+    def is_done(token_id):
+        return token_id in eos_token_ids or len(generated) >= max_new_tokens or (stop_fn is not None and stop_fn(generated))
+
+    with TRACER.span("prompt_lookup.generate", input_tokens=input_ids.shape[1]) as span:
+        start = time.perf_counter()
+        # explicit cache_position --> Qwen-VL recomputes its (3D) rope positions for this prompt
+        cache_position = torch.arange(input_ids.shape[1], device=input_ids.device)
+        outputs = model(**inputs, cache_position=cache_position, use_cache=True, logits_to_keep=1)
+        past_key_values = outputs.past_key_values
+        next_logits = outputs.logits[0, -1]
+        prefill_end = time.perf_counter()
+
+        while max_new_tokens > 0:
+            # invariant: the cache holds index.tokens, next_logits predicts the token after them
+            token_id = _greedy_token(next_logits, seen, repetition_penalty)
+            generated.append(token_id)
+            index.extend([token_id])
+            seen.add(token_id)
+            if is_done(token_id): break
+
+            draft = index.draft(min(num_draft_tokens, max_new_tokens - len(generated)))
+            step_ids = torch.tensor([[token_id] + draft], dtype=input_ids.dtype, device=input_ids.device)
+            cache_len = len(index.tokens) - 1
+            cache_position = torch.arange(cache_len, cache_len + step_ids.shape[1], device=input_ids.device)
+            outputs = model(input_ids=step_ids, past_key_values=past_key_values, cache_position=cache_position, use_cache=True)
+            past_key_values = outputs.past_key_values
+            logits = outputs.logits[0]
+            num_forwards += 1
+            num_drafted += len(draft)
+
+            # logits[j] predicts the token after draft[:j]
+            done = False
+            next_logits = logits[len(draft)]
+            for j, draft_token_id in enumerate(draft):
+                if _greedy_token(logits[j], seen, repetition_penalty) != draft_token_id:
+                    next_logits = logits[j]
+                    break
+                num_accepted += 1
+                generated.append(draft_token_id)
+                index.extend([draft_token_id])
+                seen.add(draft_token_id)
+                if is_done(draft_token_id):
+                    done = True
+                    break
+            if done: break
+            # drop the rejected draft tokens from the cache (crop(0) isn't a no-op for every cache layer)
+            num_rejected = cache_len + step_ids.shape[1] - len(index.tokens)
+            if num_rejected: past_key_values.crop(-num_rejected)
+
+        end = time.perf_counter()
+        stats = {
+            "output_tokens": len(generated),
+            "forwards": num_forwards,
+            "drafted": num_drafted,
+            "accepted": num_accepted,
+        }
+        span.update(**stats, prefill_s=round(prefill_end - start, 6), decode_s=round(end - prefill_end, 6))
+    return generated, stats
+
+
+def is_out_of_memory(error):
+    return "out of memory" in str(error).lower() or isinstance(error, torch.cuda.OutOfMemoryError)
+
+# fault_hook for AdaptiveBatcher: fails like CUDA would on every batch above max_batch_tokens (to test the backoff on CPU)
+def inject_oom_above(max_batch_tokens):
+    def fault_hook(batch_size, batch_tokens):
+        if batch_tokens > max_batch_tokens: raise RuntimeError(f"CUDA out of memory (injected: {batch_tokens} > {max_batch_tokens} tokens)")
+    return fault_hook
+
+class AdaptiveBatcher:
+    """
+    Packs requests into batches whose padded prefill (batch size * longest request, in tokens) fits the token budget;
+    requests are sorted by length so that each batch carries little padding.
+    On an out of memory error, the failing batch is split in two and retried, and the budget is lowered to half its size
+    for all the following batches (the safe size is remembered across calls). Results come back in input order.
+    fault_hook(batch_size, batch_tokens), if set, is called before every batch, e.g. to inject failures (see inject_oom_above).
+    """
+    def __init__(self, max_batch_tokens=VLM_MAX_BATCH_TOKENS, fault_hook=None):
+        self.max_batch_tokens = max_batch_tokens
+        self.safe_batch_tokens = None # learnt from out of memory errors
+        self.fault_hook = fault_hook
+        self.num_ooms = 0
+
+    def batch_token_limit(self):
+        limits = [limit for limit in (self.max_batch_tokens, self.safe_batch_tokens) if limit is not None]
+        return min(limits) if limits else None
+
+    # lists of request indices; a request longer than the budget gets a batch of its own
+    def make_batches(self, lengths):
+        limit = self.batch_token_limit()
+        batches, batch = [], []
+        for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+            # sorted order --> the current request is the longest one of the batch it joins
+            if batch and limit is not None and (len(batch) + 1) * lengths[i] > limit:
+                batches.append(batch)
+                batch = []
+            batch.append(i)
+        if batch: batches.append(batch)
+        return batches
+
+    # run_batch(list of request indices) -> one result per index
+    def run(self, lengths, run_batch):
+        results = [None] * len(lengths)
+        pending = deque(self.make_batches(lengths))
+        while pending:
+            batch = pending.popleft()
+            batch_tokens = len(batch) * max(lengths[i] for i in batch)
+            try:
+                if self.fault_hook is not None: self.fault_hook(len(batch), batch_tokens)
+                outputs = run_batch(batch)
+            except Exception as error:
+                if len(batch) == 1 or not is_out_of_memory(error): raise
+                self.num_ooms += 1
+                # halve the budget, as the batch itself is halved
+                self.safe_batch_tokens = min(self.safe_batch_tokens or batch_tokens, batch_tokens // 2)
+                with TRACER.span("batcher.oom_backoff", batch_size=len(batch), batch_tokens=batch_tokens, safe_batch_tokens=self.safe_batch_tokens):
+                    if torch.cuda.is_available(): torch.cuda.empty_cache()
+                half = len(batch) // 2
+                pending.appendleft(batch[half:])
+                pending.appendleft(batch[:half])
+                continue
+            for i, output in zip(batch, outputs):
+                results[i] = output
+        return results
+
+
+class VisionCache:
+    """
+    Decodes + smart-resizes each image file once (qwen_vl_utils.fetch_image) and runs the image processor once,
+    then shares the resulting (pixel_values, image_grid_thw) between every call that uses this image.
+    Entries are kept in an LRU bounded by max_bytes, and prefetch() fills the cache from a background thread pool.
+    """
+    def __init__(self, image_processor, max_bytes=VISION_CACHE_MAX_BYTES, num_workers=VISION_PREFETCH_WORKERS):
+        self.image_processor = image_processor
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict() # img_path -> (pixel_values, image_grid_thw)
+        self._pending = {} # img_path -> Future of an ongoing decode
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="vision-prefetch")
+
+    def _preprocess(self, img_path):
+        image = qwen_vl_utils.fetch_image({"image": img_path})
+        outputs = self.image_processor(images=[image], return_tensors="pt")
+        return outputs["pixel_values"], outputs["image_grid_thw"]
+
+    def _load(self, img_path):
+        try:
+            value = self._preprocess(img_path)
+        except BaseException:
+            with self._lock:
+                self._pending.pop(img_path, None)
+            raise
+        # the entry is added and the pending decode removed in one step, so that a concurrent get / prefetch
+        # always finds the image in one of the two (and never starts a second decode)
+        with self._lock:
+            self._pending.pop(img_path, None)
+            if img_path not in self._entries:
+                self._entries[img_path] = value
+                self.num_bytes += value[0].nbytes + value[1].nbytes
+            # evict the least recently used images, but always keep the one just loaded
+            while self.num_bytes > self.max_bytes and len(self._entries) > 1:
+                _, (pixel_values, grid_thw) = self._entries.popitem(last=False)
+                self.num_bytes -= pixel_values.nbytes + grid_thw.nbytes
+        return value
+
+    def _future(self, img_path):
+        with self._lock:
+            value = self._entries.get(img_path)
+            if value is not None:
+                self._entries.move_to_end(img_path)
+                future = Future()
+                future.set_result(value)
+                return future, True
+            future = self._pending.get(img_path)
+            if future is None:
+                future = self._executor.submit(self._load, img_path)
+                self._pending[img_path] = future
+            return future, False
+
+    def get(self, img_path):
+        future, hit = self._future(img_path)
+        with self._lock:
+            if hit: self.hits += 1
+            else: self.misses += 1
+        return future.result()
+
+    def prefetch(self, img_paths):
+        for img_path in dict.fromkeys(img_paths):
+            self._future(img_path)
+
 
 class Qwen_2_5_VL_7B_Instruct:
-    def __init__(self, ):
+    def __init__(self, load_profile=LOAD_PROFILE):
         
-        self.model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
-            "Qwen/Qwen2.5-VL-7B-Instruct", 
-            torch_dtype=torch.bfloat16, 
-            device_map="auto",
-            cache_dir=CACHE_DIR,
-            attn_implementation="flash_attention_2")
-        self.model.eval()
-        self.processor = AutoProcessor.from_pretrained("Qwen/Qwen2.5-VL-7B-Instruct", cache_dir=CACHE_DIR, use_fast=True)
-        self.processor.tokenizer.padding_side = "left"
-
-    @torch.no_grad()
+        self.model_name = "Qwen/Qwen2.5-VL-7B-Instruct"
+        self.load_profile = load_profile
+        # the processor (cheap, needed to prefetch images) and the weights are loaded separately on first use
+        self._model = None
+        self._processor = None
+        self._vision_cache = None
+        self._load_lock = threading.Lock()
+        self.num_loads = 0
+        # token-budgeted batching of get_batch_response, with out of memory backoff
+        self.batcher = AdaptiveBatcher()
+
+    @property
+    def is_loaded(self):
+        return self._model is not None
+
+    @property
+    def processor(self):
+        with self._load_lock:
+            if self._processor is None:
+                self._processor = transformers.AutoProcessor.from_pretrained(self.model_name, cache_dir=CACHE_DIR, use_fast=True)
+                self._processor.tokenizer.padding_side = "left"
+        return self._processor
+
+    @property
+    def vision_cache(self):
+        if self._vision_cache is None:
+            image_processor = self.processor.image_processor
+            with self._load_lock:
+                if self._vision_cache is None: self._vision_cache = VisionCache(image_processor)
+        return self._vision_cache
+
+    @property
+    def model(self):
+        with self._load_lock:
+            if self._model is None:
+                self._model = load_pretrained(transformers.Qwen2_5_VLForConditionalGeneration, self.model_name, self.load_profile, "vlm.load_model")
+                self.num_loads += 1
+        return self._model
+
+    def unload(self):
+        with self._load_lock:
+            was_loaded, self._model = self._model is not None, None
+        if was_loaded: free_memory()
+
+    # decode / preprocess the upcoming images in the background
+    @traced("vlm.prefetch_images")
+    def prefetch_images(self, img_paths):
+        self.vision_cache.prefetch(img_paths)
+
+    # this function is the processor(text=texts, images=...) call, but with the preprocessed images taken from the vision cache
+    # each text holds exactly one image placeholder, for the image at the same position in img_paths
+    @traced("vlm.vision_preprocess")
+    def _build_inputs(self, texts, img_paths, padding=True):
+        image_token = self.processor.image_token
+        merge_length = self.processor.image_processor.merge_size ** 2
+        pixel_values, image_grid_thw, expanded_texts = [], [], []
+        for text, img_path in zip(texts, img_paths):
+            if text.count(image_token) != 1: raise ValueError("each text must contain exactly one image.")
+            _pixel_values, _grid_thw = self.vision_cache.get(img_path)
+            pixel_values.append(_pixel_values)
+            image_grid_thw.append(_grid_thw)
+            # one placeholder per merged vision token, as done by the processor
+            expanded_texts.append(text.replace(image_token, image_token * (int(_grid_thw.prod()) // merge_length)))
+        inputs = self.processor.tokenizer(expanded_texts, padding=padding, return_tensors="pt")
+        inputs["pixel_values"] = torch.cat(pixel_values, dim=0)
+        inputs["image_grid_thw"] = torch.cat(image_grid_thw, dim=0)
+        return inputs
+
+    # prefill tokens of each (single image) text: its text tokens + the merged vision tokens of its image
+    def _prefill_lengths(self, texts, img_paths):
+        merge_length = self.processor.image_processor.merge_size ** 2
+        text_lengths = [len(ids) for ids in self.processor.tokenizer(texts).input_ids]
+        return [n - 1 + int(self.vision_cache.get(img_path)[1].prod()) // merge_length for n, img_path in zip(text_lengths, img_paths)]
+
+    @traced("vlm.get_response")
+    @no_grad
     def get_response(self, img_path, query):
         messages = [
             {
@@ -178,26 +737,16 @@ class Qwen_2_5_VL_7B_Instruct:
         ]
         # Preparation for inference
         text = self.processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-        image_inputs, video_inputs = process_vision_info(messages)
-        inputs = self.processor(
-            text=[text],
-            images=image_inputs,
-            videos=video_inputs,
-            padding=True,
-            return_tensors="pt",
-        )
+        inputs = self._build_inputs([text], [img_path])
         inputs = inputs.to(self.model.device)
         # Inference: Generation of the output
-        generated_ids = self.model.generate(**inputs, max_new_tokens=1024)
+        generated_ids = traced_generate(self.model, inputs, "vlm.generate", max_new_tokens=1024)
         generated_ids_trimmed = [out_ids[len(in_ids) :] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)]
         output_text = self.processor.batch_decode(generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False)
         return output_text[0]
     
-    @torch.no_grad()
-    def get_batch_response(self, img_paths, queries):
-
-        if len(img_paths) != len(queries): raise ValueError("img_paths and queries must have the same length.")
-
+    # chat-formatted prompt of each (image, query) pair, optionally followed by the start of the assistant answer
+    def _chat_texts(self, img_paths, queries, answer_prefixes=None):
         messages = []
         for img_path, query in zip(img_paths, queries):
             message = {
@@ -209,27 +758,109 @@ class Qwen_2_5_VL_7B_Instruct:
             }
             messages.append([message])  # Wrap each message in a list for batch processing
 
-        # Preparation for batch inference
         texts = [
             self.processor.apply_chat_template(msg, tokenize=False, add_generation_prompt=True)
             for msg in messages
         ]
-        image_inputs, video_inputs = process_vision_info(messages)
-        inputs = self.processor(
-            text=texts,
-            images=image_inputs,
-            videos=video_inputs,
-            padding=True,
-            return_tensors="pt",
-        )
-        inputs = inputs.to(self.model.device)
+        if answer_prefixes is not None:
+            texts = [text + answer_prefix for text, answer_prefix in zip(texts, answer_prefixes)]
+        return texts
+
+    # answer_prefixes (optional) are prefilled at the start of each answer; only the continuation is returned
+    @traced("vlm.get_batch_response")
+    @no_grad
+    def get_batch_response(self, img_paths, queries, answer_prefixes=None):
 
-        # Batch Inference
-        generated_ids = self.model.generate(**inputs, max_new_tokens=1024)
-        generated_ids_trimmed = [
-            out_ids[len(in_ids) :] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
+        if len(img_paths) != len(queries): raise ValueError("img_paths and queries must have the same length.")
+        if answer_prefixes is not None and len(answer_prefixes) != len(queries): raise ValueError("answer_prefixes and queries must have the same length.")
+
+        # Preparation for batch inference
+        texts = self._chat_texts(img_paths, queries, answer_prefixes)
+
+        # Batch Inference, in batches that fit the token budget (and split again on out of memory)
+        def run_batch(batch):
+            inputs = self._build_inputs([texts[i] for i in batch], [img_paths[i] for i in batch])
+            inputs = inputs.to(self.model.device)
+            generated_ids = traced_generate(self.model, inputs, "vlm.generate", max_new_tokens=1024)
+            generated_ids_trimmed = [
+                out_ids[len(in_ids) :] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
+            ]
+            return self.processor.batch_decode(
+                generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False
+            )
+        return self.batcher.run(self._prefill_lengths(texts, img_paths), run_batch)
+
+    # prefix-caching version of get_batch_response([img_path] * N, [prefix_query + q for q in suffix_queries])
+    # the image and prefix_query are encoded once and their KV cache is reused for every suffix query
+    @traced("vlm.get_prefix_cached_responses")
+    @no_grad
+    def get_prefix_cached_responses(self, img_path, prefix_query, suffix_queries):
+        messages = [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "image", "image": img_path},
+                    {"type": "text", "text": prefix_query + PREFIX_SPLIT_MARKER},
+                ],
+            }
         ]
-        output_texts = self.processor.batch_decode(
-            generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False
-        )
-        return output_texts
\ No newline at end of file
+        text = self.processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        prefix_text, template_tail = text.split(PREFIX_SPLIT_MARKER)
+        prefix_inputs = self._build_inputs([prefix_text], [img_path], padding=False)
+        prefix_inputs = prefix_inputs.to(self.model.device)
+
+        # tokenize each suffix in the context of the (un-expanded) prefix text, so that the token boundary
+        # is exactly the one of the full prompt; suffixes that would merge with the prefix are run without cache
+        tokenizer = self.processor.tokenizer
+        prefix_ids = tokenizer(prefix_text).input_ids
+        cached_idx, suffix_ids_list, uncached_idx = [], [], []
+        for i, query in enumerate(suffix_queries):
+            full_ids = tokenizer(prefix_text + query + template_tail).input_ids
+            if full_ids[:len(prefix_ids)] == prefix_ids and len(full_ids) > len(prefix_ids):
+                cached_idx.append(i)
+                suffix_ids_list.append(full_ids[len(prefix_ids):])
+            else:
+                uncached_idx.append(i)
+
+        output_texts = [None] * len(suffix_queries)
+        if suffix_ids_list:
+            generated_ids = generate_with_prefix_cache(self.model, prefix_inputs, suffix_ids_list, max_new_tokens=1024)
+            decoded = self.processor.batch_decode(generated_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
+            for i, output_text in zip(cached_idx, decoded):
+                output_texts[i] = output_text
+        if uncached_idx:
+            decoded = self.get_batch_response([img_path] * len(uncached_idx), [prefix_query + suffix_queries[i] for i in uncached_idx])
+            for i, output_text in zip(uncached_idx, decoded):
+                output_texts[i] = output_text
+        return output_texts
+
+    # same outputs as get_batch_response (greedy), but each response is decoded on its own with prompt lookup
+    # speculative decoding --> fast when the response mostly copies the query, e.g. rectification of the initial response
+    @traced("vlm.get_prompt_lookup_responses")
+    @no_grad
+    def get_prompt_lookup_responses(self, img_paths, queries):
+        if len(img_paths) != len(queries): raise ValueError("img_paths and queries must have the same length.")
+        output_texts = []
+        for text, img_path in zip(self._chat_texts(img_paths, queries), img_paths):
+            inputs = self._build_inputs([text], [img_path], padding=False)
+            inputs = inputs.to(self.model.device)
+            generated_ids, _ = generate_with_prompt_lookup(self.model, inputs, max_new_tokens=1024)
+            output_texts.append(self.processor.decode(generated_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False))
+        return output_texts
+
+    # this function is to pick between a few candidate continuations of each answer with a single forward pass (no decoding)
+    # answer_prefixes are prefilled at the start of each answer, and the candidates must start with different tokens
+    # returns the (batch, n_candidates) logits of the candidates' first tokens, as a list of lists
+    @traced("vlm.get_candidate_logits")
+    @no_grad
+    def get_candidate_logits(self, img_paths, queries, answer_prefixes, candidates):
+        if not (len(img_paths) == len(queries) == len(answer_prefixes)): raise ValueError("img_paths, queries and answer_prefixes must have the same length.")
+        candidate_token_ids = first_token_ids(self.processor.tokenizer, candidates)
+        texts = self._chat_texts(img_paths, queries, answer_prefixes)
+
+        # in batches that fit the token budget (and split again on out of memory), as in get_batch_response
+        def run_batch(batch):
+            inputs = self._build_inputs([texts[i] for i in batch], [img_paths[i] for i in batch])
+            inputs = inputs.to(self.model.device)
+            return score_first_tokens(self.model, inputs, candidate_token_ids).tolist()
+        return self.batcher.run(self._prefill_lengths(texts, img_paths), run_batch)
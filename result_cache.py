@@ -0,0 +1,131 @@
+"""
+content-addressed on-disk cache for the outputs of the three pipeline stages
+"""
+
+import os
+import json
+import hashlib
+import threading
+from collections import defaultdict
+
+from utils import RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES
+
+# one namespace per pipeline stage
+EXTRACTION = "extract_claims"
+ANNOTATION = "annotation"
+RECTIFICATION = "rectification"
+
+
+# sha256 of a file's bytes (a missing file hashes its path instead, so that it never matches an existing file)
+def file_digest(path):
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except FileNotFoundError:
+        return ResultCache.make_key("missing-image", path)
+
+class ResultCache:
+    """
+    Stores one JSON value per key under <root>/<namespace>/<key[:2]>/<key>.json.
+    Keys are hashes of everything the value depends on (model id, prompt template, input text, image bytes),
+    so changing one stage's prompt only invalidates that stage (and the stages that consume its output).
+    When the cache grows beyond max_bytes, the least recently used files are evicted (hits refresh the file mtime).
+    """
+    def __init__(self, root=RESULT_CACHE_DIR, max_bytes=RESULT_CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+        self._lock = threading.Lock()
+        self._image_digests = {}
+        self._total_bytes = sum(size for _, _, size in self._list_files())
+
+    @staticmethod
+    def make_key(*parts):
+        h = hashlib.sha256()
+        for part in parts:
+            data = part if isinstance(part, bytes) else str(part).encode("utf-8")
+            h.update(len(data).to_bytes(8, "little")) # length prefix --> ("ab", "c") != ("a", "bc")
+            h.update(data)
+        return h.hexdigest()
+
+    # sha256 of the image file, computed once per path
+    def image_digest(self, img_path):
+        with self._lock:
+            digest = self._image_digests.get(img_path)
+        if digest is None:
+            digest = file_digest(img_path)
+            with self._lock:
+                self._image_digests[img_path] = digest
+        return digest
+
+    def _path(self, namespace, key):
+        return os.path.join(self.root, namespace, key[:2], key + ".json")
+
+    def get(self, namespace, key, default=None):
+        path = self._path(namespace, key)
+        try:
+            with open(path, "r") as f:
+                value = json.load(f)["value"]
+        except (OSError, ValueError, KeyError):
+            with self._lock:
+                self.misses[namespace] += 1
+            return default
+        try:
+            os.utime(path) # LRU bookkeeping
+        except OSError:
+            pass
+        with self._lock:
+            self.hits[namespace] += 1
+        return value
+
+    def put(self, namespace, key, value):
+        path = self._path(namespace, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = json.dumps({"value": value}).encode("utf-8")
+        old_size = os.path.getsize(path) if os.path.exists(path) else 0
+        # write + rename --> readers never see a partial file
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._total_bytes += len(data) - old_size
+            over_budget = self.max_bytes is not None and self._total_bytes > self.max_bytes
+        if over_budget: self.evict()
+
+    def _list_files(self):
+        files = []
+        if not os.path.isdir(self.root): return files
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                if not name.endswith(".json"): continue
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, path, stat.st_size))
+        return files
+
+    # drop the least recently used files until the cache is back to 90% of max_bytes
+    def evict(self):
+        with self._lock:
+            files = sorted(self._list_files())
+            total = sum(size for _, _, size in files)
+            target = int(self.max_bytes * 0.9)
+            for _, path, size in files:
+                if total <= target: break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+            self._total_bytes = total
+
+    def report(self):
+        report = {}
+        for namespace in sorted(set(self.hits) | set(self.misses)):
+            hits, misses = self.hits[namespace], self.misses[namespace]
+            report[namespace] = {"hits": hits, "misses": misses, "hit_rate": round(hits / max(hits + misses, 1), 3)}
+        return report
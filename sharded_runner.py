@@ -0,0 +1,153 @@
+"""
+runs qwen_HAL_annotator.main() as N deterministic shards, one worker process per device, then merges the shard outputs
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import subprocess
+
+from annotation_store import write_annotation_store
+from manifest import RunManifest
+from utils import DATA_PATH, SAVE_PATH, MAX_SHARD_RETRIES, WRITE_ANNOTATION_STORE, get_output_paths, entry_key, read_jsonl_results
+
+
+def shard_save_path(shards_dir, shard_id):
+    return os.path.join(shards_dir, f"shard_{shard_id:03d}.json")
+
+# this function is the body of a worker process: it annotates one shard, resuming from its partial output if any
+def run_shard(shard_id, num_shards, data_path, shards_dir, backend="qwen", limit=None):
+    import qwen_HAL_annotator
+    qwen_llm, qwen_vlm, fake_kwargs = None, None, {}
+    if backend != "qwen":
+        # fake backends (CPU tests): no result cache, which would be shared with real runs
+        from benchmark import make_backends
+        qwen_llm, qwen_vlm = make_backends(backend)
+        fake_kwargs = {"use_cache": False}
+    return qwen_HAL_annotator.main(
+        qwen_llm=qwen_llm, qwen_vlm=qwen_vlm,
+        data_path=data_path, save_path=shard_save_path(shards_dir, shard_id),
+        resume=True, limit=limit, shard=(shard_id, num_shards), **fake_kwargs)
+
+# this function is to rebuild a single ordered Qwen_HAL_Annotations.json from the (streamed) shard outputs
+def merge_shards(data_path, shards_dir, num_shards, save_path, limit=None):
+    with open(data_path, "r") as f:
+        val_data = json.load(f)
+    if limit is not None: val_data = val_data[:limit]
+    results = {}
+    for shard_id in range(num_shards):
+        for result in read_jsonl_results(get_output_paths(shard_save_path(shards_dir, shard_id))["stream"]):
+            results[entry_key(result)] = result
+    merged = [results[entry_key(entry)] for entry in val_data if entry_key(entry) in results]
+    missing = len(val_data) - len(merged)
+    with open(save_path, "w") as outfile:
+        json.dump(merged, outfile, indent=4)
+    if WRITE_ANNOTATION_STORE: write_annotation_store(merged, get_output_paths(save_path)["store"])
+    # the merged manifest lets a later incremental run of the whole dataset diff against this output
+    manifest = RunManifest(get_output_paths(save_path)["manifest"])
+    for shard_id in range(num_shards):
+        manifest.entries.update(RunManifest(get_output_paths(shard_save_path(shards_dir, shard_id))["manifest"]).entries)
+    manifest.save()
+    return merged, missing
+
+
+class ShardedRunner:
+    """
+    Launches one worker process per shard, at most one per device at a time (CUDA_VISIBLE_DEVICES=<device>,
+    or plain CPU workers when devices are "cpu"). A failed shard is re-launched on its own, up to max_retries times,
+    and resumes from its partial output. Worker logs are written next to the shard outputs.
+    """
+    def __init__(self, devices, num_shards=None, data_path=DATA_PATH, save_path=SAVE_PATH, backend="qwen",
+                 limit=None, max_retries=MAX_SHARD_RETRIES, poll_interval=1.0):
+        if not devices: raise ValueError("at least one device is required.")
+        self.devices = list(devices)
+        self.num_shards = num_shards or len(self.devices)
+        self.data_path = data_path
+        self.save_path = save_path
+        self.shards_dir = get_output_paths(save_path)["shards"]
+        self.backend = backend
+        self.limit = limit
+        self.max_retries = max_retries
+        self.poll_interval = poll_interval
+        self.attempts = {shard_id: 0 for shard_id in range(self.num_shards)}
+
+    def _launch(self, shard_id, device):
+        command = [sys.executable, os.path.abspath(__file__), "worker",
+                   "--shard-id", str(shard_id), "--num-shards", str(self.num_shards),
+                   "--data-path", self.data_path, "--shards-dir", self.shards_dir, "--backend", self.backend]
+        if self.limit is not None: command += ["--limit", str(self.limit)]
+        env = dict(os.environ)
+        env["CUDA_VISIBLE_DEVICES"] = "" if device == "cpu" else str(device)
+        self.attempts[shard_id] += 1
+        log_file = open(os.path.join(self.shards_dir, f"shard_{shard_id:03d}.log"), "a")
+        process = subprocess.Popen(command, env=env, stdout=log_file, stderr=subprocess.STDOUT, cwd=os.path.dirname(os.path.abspath(__file__)))
+        return process, log_file
+
+    def run(self, fresh=False):
+        if fresh and os.path.isdir(self.shards_dir): shutil.rmtree(self.shards_dir)
+        os.makedirs(self.shards_dir, exist_ok=True)
+        pending = list(range(self.num_shards))
+        free_devices = list(self.devices)
+        running = {} # shard_id -> (process, log file, device)
+        failed = []
+        while pending or running:
+            while pending and free_devices:
+                shard_id, device = pending.pop(0), free_devices.pop(0)
+                process, log_file = self._launch(shard_id, device)
+                running[shard_id] = (process, log_file, device)
+                print(f"shard {shard_id}: started on device {device} (attempt {self.attempts[shard_id]})")
+            time.sleep(self.poll_interval)
+            for shard_id, (process, log_file, device) in list(running.items()):
+                returncode = process.poll()
+                if returncode is None: continue
+                log_file.close()
+                del running[shard_id]
+                free_devices.append(device)
+                if returncode == 0:
+                    print(f"shard {shard_id}: done")
+                elif self.attempts[shard_id] <= self.max_retries:
+                    print(f"shard {shard_id}: failed with exit code {returncode}, retrying")
+                    pending.append(shard_id)
+                else:
+                    print(f"shard {shard_id}: failed with exit code {returncode}, giving up")
+                    failed.append(shard_id)
+
+        _, missing = merge_shards(self.data_path, self.shards_dir, self.num_shards, self.save_path, self.limit)
+        print(f"\nMerged {self.num_shards} shards into {self.save_path} ({missing} entries missing)\n")
+        return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="annotate the dataset with one worker process per device")
+    run_parser.add_argument("--devices", default="0", help="comma-separated CUDA devices, or 'cpu'")
+    run_parser.add_argument("--num-workers", type=int, default=1, help="number of CPU workers when --devices cpu")
+    run_parser.add_argument("--num-shards", type=int, default=None, help="defaults to one shard per worker")
+    run_parser.add_argument("--data-path", default=DATA_PATH)
+    run_parser.add_argument("--save-path", default=SAVE_PATH)
+    run_parser.add_argument("--backend", choices=["qwen", "stub", "tiny"], default="qwen")
+    run_parser.add_argument("--limit", type=int, default=None)
+    run_parser.add_argument("--max-retries", type=int, default=MAX_SHARD_RETRIES)
+    run_parser.add_argument("--fresh", action="store_true", help="discard the partial shard outputs of a previous run")
+
+    worker_parser = subparsers.add_parser("worker", help="annotate a single shard (launched by 'run')")
+    worker_parser.add_argument("--shard-id", type=int, required=True)
+    worker_parser.add_argument("--num-shards", type=int, required=True)
+    worker_parser.add_argument("--data-path", required=True)
+    worker_parser.add_argument("--shards-dir", required=True)
+    worker_parser.add_argument("--backend", default="qwen")
+    worker_parser.add_argument("--limit", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.command == "worker":
+        run_shard(args.shard_id, args.num_shards, args.data_path, args.shards_dir, args.backend, args.limit)
+    else:
+        devices = ["cpu"] * args.num_workers if args.devices == "cpu" else args.devices.split(",")
+        runner = ShardedRunner(devices, args.num_shards, args.data_path, args.save_path, args.backend, args.limit, args.max_retries)
+        failed = runner.run(fresh=args.fresh)
+        if failed: sys.exit(f"shards {failed} failed after {args.max_retries} retries")
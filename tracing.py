@@ -0,0 +1,195 @@
+"""
+lightweight spans (latency, token counts, memory) for the wrappers and the annotator, with JSON and Chrome-trace outputs
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+import resource
+import functools
+from collections import deque
+from contextlib import contextmanager
+
+from utils import TRACING, TRACE_MAX_EVENTS, TRACE_LATENCY_WINDOW
+
+# ratios reported from the summed span attributes (a per-call ratio can't be summed): name -> (numerator, denominator)
+SUMMARY_RATIOS = {"acceptance_rate": ("accepted", "drafted")}
+
+
+# memory in MB now (current) and since the last reset_peak_memory (peak): CUDA allocator (summed over the GPUs)
+# when torch is in use with a GPU, process RSS otherwise
+def _cuda():
+    torch = sys.modules.get("torch") # never import torch just for this
+    if torch is not None and torch.cuda.is_available() and torch.cuda.is_initialized(): return torch.cuda
+    return None
+
+def current_memory_mb():
+    cuda = _cuda()
+    if cuda is not None:
+        return sum(cuda.memory_allocated(device) for device in range(cuda.device_count())) / 1024 ** 2
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # kB on Linux
+
+_last_maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+# the CUDA peak is reset after every read; the peak RSS can't be, so a window in which it didn't grow
+# only knows the current RSS at its end
+def reset_peak_memory():
+    global _last_maxrss
+    cuda = _cuda()
+    if cuda is not None:
+        peak = sum(cuda.max_memory_allocated(device) for device in range(cuda.device_count())) / 1024 ** 2
+        for device in range(cuda.device_count()):
+            cuda.reset_peak_memory_stats(device)
+        return peak
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    peak = maxrss if maxrss > _last_maxrss else current_memory_mb()
+    _last_maxrss = maxrss
+    return peak
+
+def _percentile(sorted_values, q):
+    if not sorted_values: return 0.0
+    idx = min(int(round(q * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[idx]
+
+
+class _SpanStats:
+    """
+    Running aggregates of one span name; the latency percentiles are over the last `window` calls.
+    """
+    def __init__(self, window):
+        self.count = 0
+        self.total_s = 0.0
+        self.max_s = 0.0
+        self.durations = deque(maxlen=window)
+        self.totals = {}
+        self.peak_memory_mb = 0.0
+
+    def add(self, dur, attrs):
+        self.count += 1
+        self.total_s += dur
+        self.max_s = max(self.max_s, dur)
+        self.durations.append(dur)
+        for key, value in attrs.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool) and key != "peak_memory_mb":
+                self.totals[key] = self.totals.get(key, 0) + value
+        self.peak_memory_mb = max(self.peak_memory_mb, attrs.get("peak_memory_mb", 0))
+
+
+class Tracer:
+    """
+    Records one event per span: name, start, duration, thread and numeric/str attributes set by the traced code.
+    Spans are folded into per-name aggregates, and only the last max_events events are kept (for the Chrome trace),
+    so memory stays bounded and the tracer can stay on in production; set enabled=False to make spans no-ops.
+    The peak memory of a span is its own: the allocator peak is read and reset at every span boundary, and each
+    open span keeps the max of the windows it was open for.
+    """
+    def __init__(self, enabled=True, max_events=TRACE_MAX_EVENTS, latency_window=TRACE_LATENCY_WINDOW):
+        self.enabled = enabled
+        self.max_events = max_events
+        self.latency_window = latency_window
+        self._lock = threading.Lock()
+        self._open = {} # id of an open span -> its peak memory so far
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.events = deque(maxlen=self.max_events)
+            self.num_dropped = 0
+            self.stats = {}
+            self._origin = time.perf_counter()
+
+    # this function is to close the current memory window: its peak goes to every open span (call under the lock)
+    def _fold_memory_window(self):
+        peak = reset_peak_memory()
+        for span_id, span_peak in self._open.items():
+            if peak > span_peak: self._open[span_id] = peak
+
+    # the yielded dict can be filled with attributes (tokens, batch size, ...) inside the span
+    @contextmanager
+    def span(self, name, **attrs):
+        if not self.enabled:
+            yield attrs
+            return
+        span_id = object()
+        with self._lock:
+            self._fold_memory_window()
+            self._open[span_id] = current_memory_mb()
+        start = time.perf_counter()
+        try:
+            yield attrs
+        finally:
+            end = time.perf_counter()
+            with self._lock:
+                self._fold_memory_window()
+                attrs["peak_memory_mb"] = round(self._open.pop(span_id), 1)
+                if len(self.events) == self.max_events: self.num_dropped += 1
+                self.events.append({"name": name, "start": start - self._origin, "dur": end - start, "tid": threading.get_ident(), "attrs": attrs})
+                if name not in self.stats: self.stats[name] = _SpanStats(self.latency_window)
+                self.stats[name].add(end - start, attrs)
+
+    # per span name: call count, latency stats (ms, percentiles over the last latency_window calls),
+    # the sum of every numeric attribute (+ the SUMMARY_RATIOS of those sums) and the peak memory
+    def summary(self):
+        with self._lock:
+            items = [(name, stats, sorted(d * 1000 for d in stats.durations)) for name, stats in self.stats.items()]
+            summary = {}
+            for name, stats, durations in items:
+                summary[name] = {
+                    "count": stats.count,
+                    "total_s": round(stats.total_s, 3),
+                    "mean_ms": round(stats.total_s * 1000 / stats.count, 2),
+                    "p50_ms": round(_percentile(durations, 0.50), 2),
+                    "p95_ms": round(_percentile(durations, 0.95), 2),
+                    "p99_ms": round(_percentile(durations, 0.99), 2),
+                    "max_ms": round(stats.max_s * 1000, 2),
+                    **{f"sum_{key}": round(value, 3) for key, value in stats.totals.items()},
+                    "peak_memory_mb": stats.peak_memory_mb,
+                }
+                for ratio, (numerator, denominator) in SUMMARY_RATIOS.items():
+                    if numerator in stats.totals and denominator in stats.totals:
+                        total = stats.totals[denominator]
+                        summary[name][ratio] = round(stats.totals[numerator] / total, 4) if total else 0.0
+        return summary
+
+    def write_report(self, path, extra=None):
+        report = {"spans": self.summary(), "dropped_events": self.num_dropped}
+        if extra: report.update(extra)
+        with open(path, "w") as f:
+            json.dump(report, f, indent=4)
+        return report
+
+    # open with chrome://tracing or https://ui.perfetto.dev
+    def write_chrome_trace(self, path):
+        with self._lock:
+            events = list(self.events)
+        trace_events = [{
+            "name": event["name"],
+            "ph": "X",
+            "ts": event["start"] * 1e6,
+            "dur": event["dur"] * 1e6,
+            "pid": os.getpid(),
+            "tid": event["tid"],
+            "args": event["attrs"],
+        } for event in events]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
+
+
+# process-wide tracer used by qwen_wrapper and qwen_HAL_annotator
+TRACER = Tracer(enabled=TRACING)
+
+# decorator version of TRACER.span, for whole functions / methods
+def traced(name):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with TRACER.span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
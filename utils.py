@@ -2,10 +2,203 @@
 all paths, constants, and utility functions go here
 """
 
+import json
+import os
+
 CACHE_DIR = "../hf_models/"
 
+# how the LLM / VLM weights are loaded: "bf16", "int8", "int4", "cpu-offload" or "cpu" (see qwen_wrapper.LOAD_PROFILES)
+LOAD_PROFILE = "bf16"
+# cpu-offload profile: GPU memory used per device, CPU memory used before spilling to OFFLOAD_DIR
+OFFLOAD_GPU_MEMORY = "10GiB"
+OFFLOAD_CPU_MEMORY = "48GiB"
+OFFLOAD_DIR = "../hf_offload/"
+
+# extract the claims of all the entries first, then unload the LLM before annotation / rectification,
+# so that only one model is resident at a time (no pipelining between the LLM and VLM stages)
+SEQUENTIAL_MODELS = False
+
 IMAGE_DIR = "../MSCOCO/train2014/"
 
 DATA_PATH = "Qwen-2.5-VL-Hallucination-Detection-and-Mitigation/filtered_povid.json"
 
-SAVE_PATH = "Qwen-2.5-VL-Hallucination-Detection-and-Mitigation/Qwen_HAL_Annotations.json"
\ No newline at end of file
+SAVE_PATH = "Qwen-2.5-VL-Hallucination-Detection-and-Mitigation/Qwen_HAL_Annotations.json"
+
+# files written next to an output JSON: streamed results (one JSON object per line, compacted into the output
+# at the end of the run), per-run report, Chrome trace, the per-shard outputs of sharded_runner.py,
+# the indexed annotation store (see annotation_store.py) and the manifest of resumed / incremental runs (see manifest.py)
+def get_output_paths(save_path):
+    base = os.path.splitext(save_path)[0]
+    return {"stream": base + ".jsonl", "report": base + "_run_report.json", "trace": base + "_trace.json", "shards": base + "_shards", "store": base + "_store", "manifest": base + "_manifest.json"}
+
+# skip the entries already streamed next to SAVE_PATH whose stage hashes still match the manifest (see manifest.py),
+# set to False to start from scratch
+RESUME = True
+
+# only recompute the entries / stages whose inputs, prompt templates or models changed since the last run,
+# according to the manifest written next to SAVE_PATH (see manifest.py)
+INCREMENTAL = False
+
+# fsync the streamed results every N entries
+FSYNC_EVERY = 16
+
+# per-run tracing of the wrappers / stages, written next to SAVE_PATH
+TRACING = True
+# events kept for the Chrome trace (the oldest are dropped), calls per span name the latency percentiles are over
+TRACE_MAX_EVENTS = 100000
+TRACE_LATENCY_WINDOW = 10000
+
+# also write the compacted results as an indexed, memory-mapped store (queried by analyse_qwen_annotations.py)
+WRITE_ANNOTATION_STORE = True
+
+# number of times sharded_runner.py re-launches a failed shard
+MAX_SHARD_RETRIES = 2
+
+# on-disk cache of claim extraction / annotation / rectification outputs (reruns only recompute what changed)
+USE_RESULT_CACHE = True
+RESULT_CACHE_DIR = "../hal_result_cache/"
+RESULT_CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+# number of POVID entries whose claims are pooled together before annotation
+ENTRIES_PER_CHUNK = 64
+
+# max number of captions per generate call during claim extraction
+EXTRACTION_BATCH_SIZE = 16
+
+# max number of claims per get_batch_response call during annotation (the token budget is VLM_MAX_BATCH_TOKENS)
+ANNOTATION_BATCH_SIZE = 16
+
+# annotate each (image, normalized claim) pair once per run and reuse its annotation for the other occurrences
+DEDUP_CLAIMS = True
+
+# rough token counts of the offline benchmark's fake backends (a 640x480 COCO image is ~390 vision tokens)
+CHARS_PER_TOKEN = 4
+IMAGE_TOKEN_ESTIMATE = 400
+
+# decoded + preprocessed images kept in memory by the VLM wrapper (a 640x480 COCO image is ~7MB of float32 patches)
+VISION_CACHE_MAX_BYTES = 2 * 1024 ** 3
+VISION_PREFETCH_WORKERS = 4
+
+# padded prefill budget (batch size * longest prompt, text + image tokens, counted with the real tokenizer) of each
+# forward in the VLM's get_batch_response / get_candidate_logits (None --> no limit); lowered automatically after an
+# out of memory error. The only token budget: the annotation batches are split against it
+VLM_MAX_BATCH_TOKENS = None
+
+# encode the image + annotation preamble once per image and fork its KV cache for every claim
+# (claims are then decoded one at a time instead of in padded batches)
+USE_PREFIX_CACHE = False
+
+# read the verdict from the logits of one forward pass (hallucination vs non-hallucination after "[EVALUATION]:")
+# instead of decoding the whole annotation; the [REASON] is then only generated for the flagged claims
+USE_FAST_VERDICT = False
+FAST_VERDICT_EXPLAIN_FLAGGED = True
+
+# (temperature, bias) of p(hallucination) = sigmoid(logit margin / temperature + bias), see fit_verdict_calibration;
+# the values fitted by `python qwen_HAL_annotator.py --calibrate` are saved to VERDICT_CALIBRATION_PATH and take precedence
+VERDICT_CALIBRATION = (1.0, 0.0)
+VERDICT_CALIBRATION_PATH = "Qwen-2.5-VL-Hallucination-Detection-and-Mitigation/verdict_calibration.json"
+# generated annotations (claims with a hallucination / non-hallucination verdict) the calibration is fitted on
+VERDICT_CALIBRATION_CLAIMS = 512
+
+# max number of entries per get_batch_response call during rectification (entries without flagged claims are skipped)
+RECTIFICATION_BATCH_SIZE = 8
+
+# greedy prompt lookup speculative decoding for claim extraction (LLM) and rectification (VLM), one sequence at a time:
+# up to PROMPT_LOOKUP_NUM_TOKENS tokens are drafted from the prompt by matching the last (up to) PROMPT_LOOKUP_MAX_NGRAM tokens
+USE_PROMPT_LOOKUP = False
+PROMPT_LOOKUP_NUM_TOKENS = 10
+PROMPT_LOOKUP_MAX_NGRAM = 3
+
+# hal_server.py: max requests per stage batch, and how long a stage waits for more requests before starting a batch
+SERVE_MAX_BATCH_ENTRIES = 16
+SERVE_MAX_WAIT_S = 0.01
+SERVE_HOST = "127.0.0.1"
+SERVE_PORT = 8080
+
+# run image prefetch / claim extraction / annotation / rectification of consecutive chunks concurrently
+USE_PIPELINE = True
+
+# max number of chunks waiting between two pipeline stages
+PIPELINE_QUEUE_SIZE = 1
+
+
+# ---------------------------
+        # Streaming output
+# ---------------------------
+
+# an entry is identified by (image, prompt), as the same COCO image can be used by more than one POVID sample
+def entry_key(entry):
+    return (entry["image"], entry["prompt"])
+
+def read_jsonl_results(path):
+    results = []
+    if not os.path.exists(path): return results
+    with open(path, "r") as f:
+        for line in f:
+            if not line.endswith("\n"): break # partial line left by a crash, it will be recomputed
+            results.append(json.loads(line))
+    return results
+
+class JsonlResultWriter:
+    """
+    Appends one JSON result per line to `path`, flushing after every result and fsync-ing every `fsync_every` results.
+    With resume=True the existing file is kept (after dropping a partial last line), otherwise it is truncated.
+    on_sync, if set, is called after every fsync (e.g. to persist bookkeeping that must not lag behind the results).
+    """
+    def __init__(self, path, resume=True, fsync_every=FSYNC_EVERY, on_sync=None):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.on_sync = on_sync
+        self.num_unsynced = 0
+        if resume and os.path.exists(path):
+            self._drop_partial_line()
+            self.file = open(path, "a")
+        else:
+            self.file = open(path, "w")
+
+    def _drop_partial_line(self):
+        with open(self.path, "rb+") as f:
+            data = f.read()
+            if data and not data.endswith(b"\n"):
+                f.truncate(data.rfind(b"\n") + 1)
+
+    def write(self, result):
+        self.file.write(json.dumps(result) + "\n")
+        self.file.flush()
+        self.num_unsynced += 1
+        if self.num_unsynced >= self.fsync_every: self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.num_unsynced = 0
+        if self.on_sync is not None: self.on_sync()
+
+    def close(self):
+        if self.file.closed: return
+        self.sync()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# this function is to rebuild the Qwen_HAL_Annotations.json layout (a single list, in dataset order) from the streamed results
+def compact_results(stream_path, save_path, dataset=None):
+    results = {}
+    for result in read_jsonl_results(stream_path):
+        results[entry_key(result)] = result # latest result wins
+    if dataset is not None:
+        ordered = [results[entry_key(entry)] for entry in dataset if entry_key(entry) in results]
+    else:
+        ordered = list(results.values())
+    with open(save_path, "w") as outfile:
+        json.dump(ordered, outfile, indent=4)
+    return ordered
+
+# deterministic round-robin split of the dataset --> shard sizes differ by at most one entry
+def get_shard(data, shard_id, num_shards):
+    if not 0 <= shard_id < num_shards: raise ValueError(f"shard_id must be in [0, {num_shards}).")
+    return data[shard_id::num_shards]